@@ -1,173 +1,163 @@
-from flask import Flask, render_template, request, jsonify
-import boto3
+from dotenv import load_dotenv
+
+# 加载环境变量（需在导入其他模块前完成，它们在导入时读取配置）
+load_dotenv()
+
+from flask import Flask, Request, render_template, request, jsonify, Response, stream_with_context
+from werkzeug.utils import secure_filename
 import requests
+import re
+import json
+import time
+import queue
+import threading
+import io
 import os
 import uuid
-import re
-from html.parser import HTMLParser
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import run_concurrent
+from core import (get_s3_client, get_http_session, BUCKET_NAME, upload_image, upload_responsive_image, public_url,
+                  hosted_prefixes, observed)
+from transfer import (file_extension, resolve_key_mode, adopt_content_key, put_stream, object_exists, presign_put,
+                      confirm_direct_upload, DIRECT_UPLOAD, PRESIGN_EXPIRES)
+from optimize import resolve_optimize, optimize_requested, optimize_image
+from multipart import MultipartUploadWriter
+from markdown_images import ImageHTMLParser, extract_images_from_markdown, rewrite_markdown
+from metrics import stage, render_metrics
+from limits import MAX_OBJECT_SIZE, check_size, get_byte_budget
+from journal import get_journal, document_key
+from data_uri import describe_url
+from deadline import request_deadline
+from planner import plan_transfers, size_transfers, PLAN_HEAD_REQUESTS
+from document_stream import rewrite_markdown_stream
+from jobs import JobStore, JobManager, JOB_STORE_PATH, job_to_dict
+from blob_cache import init_blob_cache
+
+# 上传的文件直接以分片方式写入R2的接口
+STREAMING_UPLOAD_ENDPOINTS = {'upload_local', 'upload_batch'}
+# multipart 表单中分隔符、字段头等额外内容的余量，用于按请求大小提前拒绝超大文件
+FORM_OVERHEAD = 64 * 1024
+# 批量上传接口同时完成上传的文件数
+BATCH_UPLOAD_WORKERS = int(os.getenv('BATCH_UPLOAD_WORKERS', '4'))
+
+class StreamingUploadRequest(Request):
+    """
+    对指定接口，表单中的文件不再写入临时文件，而是边接收边分片上传到R2
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # 需要优化的图片要完整解码，仍使用临时文件
+        if (self.endpoint not in STREAMING_UPLOAD_ENDPOINTS or not filename
+                or resolve_optimize(self.args.get('optimize'))):
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        batch = self.endpoint == 'upload_batch'
+        if batch:
+            # 表单按顺序解析，开始接收下一个文件时上一个文件已经写完，
+            # 先在后台完成它的上传（同时归还内存预算），再为新文件申请
+            if self.batch_uploads:
+                self.finish_batch_upload(self.batch_uploads[-1])
+        elif total_content_length is not None:
+            # 在上传任何分片之前，先按请求大小拒绝明显超限的文件
+            check_size(total_content_length - FORM_OVERHEAD)
+        writer = MultipartUploadWriter(
+            get_s3_client(),
+            BUCKET_NAME,
+            f"{uuid.uuid4()}{file_extension(filename)}",
+            content_type,
+            max_size=MAX_OBJECT_SIZE,
+            budget=get_byte_budget(),
+            # 单个文件（批量上传中的任一文件）都不会超过整个请求体，按请求大小限制内存预算的申请
+            expected_size=total_content_length
+        )
+        self.upload_writers.append(writer)
+        if batch:
+            self.batch_uploads.append({'filename': filename, 'writer': writer, 'future': None})
+        return writer
+
+    @property
+    def upload_writers(self):
+        if 'upload_writers' not in self.__dict__:
+            self.__dict__['upload_writers'] = []
+        return self.__dict__['upload_writers']
+
+    @property
+    def batch_uploads(self):
+        """
+        批量上传中按接收顺序排列的文件：{'filename', 'writer', 'future'}
+        """
+        if 'batch_uploads' not in self.__dict__:
+            self.__dict__['batch_uploads'] = []
+        return self.__dict__['batch_uploads']
+
+    def finish_batch_upload(self, entry):
+        """
+        在本请求的线程池中完成一个文件的上传，线程数不超过 BATCH_UPLOAD_WORKERS
+        """
+        if entry['future'] is None:
+            if 'batch_executor' not in self.__dict__:
+                self.__dict__['batch_executor'] = ThreadPoolExecutor(max_workers=max(1, BATCH_UPLOAD_WORKERS))
+            key_mode = self.args.get('key_mode')
+            entry['future'] = self.__dict__['batch_executor'].submit(
+                observed, entry['filename'], None,
+                lambda stats: finish_streamed_upload(entry['writer'], entry['filename'], key_mode, stats)
+            )
+        return entry['future']
 
-# 加载环境变量
-load_dotenv()
+    def close(self):
+        executor = self.__dict__.get('batch_executor')
+        if executor is not None:
+            executor.shutdown(wait=True)
+        super().close()
 
 app = Flask(__name__)
+app.request_class = StreamingUploadRequest
 
-# 从环境变量读取 Cloudflare R2 配置
-ACCESS_KEY_ID = os.getenv('ACCESS_KEY_ID')
-SECRET_ACCESS_KEY = os.getenv('SECRET_ACCESS_KEY')
-ENDPOINT_URL = os.getenv('ENDPOINT_URL')
-BUCKET_NAME = os.getenv('BUCKET_NAME')
-CUSTOM_DOMAIN = os.getenv('CUSTOM_DOMAIN', 'https://your-domain.com')
-
-# 检查必要的环境变量
-if not all([ACCESS_KEY_ID, SECRET_ACCESS_KEY, ENDPOINT_URL, BUCKET_NAME]):
-    raise ValueError("请在 .env 文件中配置所有必要的环境变量: ACCESS_KEY_ID, SECRET_ACCESS_KEY, ENDPOINT_URL, BUCKET_NAME")
-
-# Initialize a session using S3-compatible API
-session = boto3.session.Session()
-client = session.client('s3',
-                        region_name='auto',
-                        endpoint_url=ENDPOINT_URL,
-                        aws_access_key_id=ACCESS_KEY_ID,
-                        aws_secret_access_key=SECRET_ACCESS_KEY)
-
-class ImageHTMLParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.img_src = None
-        self.img_width = None
-    
-    def handle_starttag(self, tag, attrs):
-        if tag == 'img':
-            for attr, value in attrs:
-                if attr == 'src':
-                    self.img_src = value
-                elif attr == 'width':
-                    self.img_width = value
-
-def upload_single_image(image_url):
+def upload_single_image(image_url, key_mode=None, stats=None, optimize=None, width=None, srcset=False,
+                        deadline=None):
     """
     上传单个图片到R2并返回新的URL
+    key_mode 为 'uuid' 或 'hash'，默认取环境变量 KEY_MODE
+    optimize 为 'webp' / 'avif' / 'keep' 时先优化图片，width 为缩放的目标宽度
+    srcset 为 True 时生成多个尺寸的版本，返回 {'src', 'srcset', 'sizes'} 字典
+    传入 stats 字典时会写入传输字节数、是否命中缓存，失败时写入 error
+    deadline 为请求的截止时间，到期时中止传输并按失败处理
     """
     try:
-        print(f"正在下载图片: {image_url}")
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status()
-
-        # Create downloads directory if not exists
-        os.makedirs('downloads', exist_ok=True)
-
-        # Generate a random filename while preserving the extension
-        original_filename = os.path.basename(image_url.split('?')[0])
-        file_extension = os.path.splitext(original_filename)[1]
-        random_filename = f"{uuid.uuid4()}{file_extension}"
-        filename = random_filename
-
-        # Save image locally
-        local_path = os.path.join('downloads', filename)
-        with open(local_path, 'wb') as f:
-            f.write(response.content)
-
-        # Upload the image to R2 from local file
-        print(f"正在上传 {filename} 到 R2...")
-        with open(local_path, 'rb') as file_obj:
-            client.upload_fileobj(
-                file_obj,
-                BUCKET_NAME,
-                filename,
-                ExtraArgs={'ACL': 'public-read', 'ContentType': response.headers.get('Content-Type', 'image/jpeg')}
-            )
-
-        # Construct the public URL of the uploaded image
-        public_url = f"{CUSTOM_DOMAIN}/{filename}"
-        print(f"✅ 图片上传成功: {public_url}")
-        return public_url
+        print(f"正在下载图片: {describe_url(image_url)}")
+        # Stream the image to R2 without touching the local disk,
+        # reusing the URL cache when the source was mirrored before
+        if srcset:
+            new_url = upload_responsive_image(image_url, width, key_mode, stats, optimize, deadline)
+        else:
+            new_url = upload_image(image_url, key_mode=key_mode, stats=stats, optimize=optimize, width=width,
+                                   deadline=deadline)
+        print(f"✅ 图片上传成功: {new_url}")
+        return new_url
 
     except Exception as e:
         print(f"❌ 上传图片失败: {e}")
+        if stats is not None:
+            stats['error'] = str(e)
         return None
 
-def extract_images_from_markdown(text):
-    """
-    从markdown文本中提取所有图片信息
-    支持markdown语法 ![alt](url) 和 HTML img标签，以及包含在<a>标签中的img标签
-    """
-    images = []
-    
-    # 提取markdown图片语法 ![alt](url)
-    markdown_pattern = r'!\[([^\]]*)\]\(([^)]+)\)'
-    markdown_matches = re.finditer(markdown_pattern, text)
-    for match in markdown_matches:
-        images.append({
-            'type': 'markdown',
-            'full_match': match.group(0),
-            'alt': match.group(1),
-            'url': match.group(2),
-            'start': match.start(),
-            'end': match.end()
-        })
-    
-    # 优先提取包含在<a>标签中的<img>标签
-    a_img_pattern = r'<a\s+[^>]*>\s*<img\s+[^>]*>\s*</a>'
-    a_img_matches = re.finditer(a_img_pattern, text, re.IGNORECASE | re.DOTALL)
-    for match in a_img_matches:
-        full_a_tag = match.group(0)
-        # 从<a>标签中提取<img>标签
-        img_pattern_in_a = r'<img\s+[^>]*>'
-        img_match = re.search(img_pattern_in_a, full_a_tag, re.IGNORECASE)
-        if img_match:
-            img_tag = img_match.group(0)
-            parser = ImageHTMLParser()
-            parser.feed(img_tag)
-            if parser.img_src:
-                images.append({
-                    'type': 'a_img',  # 新类型：包含在a标签中的img
-                    'full_match': full_a_tag,
-                    'img_tag': img_tag,
-                    'url': parser.img_src,
-                    'width': parser.img_width,
-                    'start': match.start(),
-                    'end': match.end()
-                })
-    
-    # 提取单独的HTML img标签（不在<a>标签中的）
-    img_pattern = r'<img\s+[^>]*>'
-    img_matches = re.finditer(img_pattern, text, re.IGNORECASE)
-    for match in img_matches:
-        img_tag = match.group(0)
-        
-        # 检查这个img标签是否已经被包含在a标签中处理过了
-        already_processed = False
-        for existing_img in images:
-            if (existing_img['type'] == 'a_img' and 
-                match.start() >= existing_img['start'] and 
-                match.end() <= existing_img['end']):
-                already_processed = True
-                break
-        
-        if not already_processed:
-            parser = ImageHTMLParser()
-            parser.feed(img_tag)
-            if parser.img_src:
-                images.append({
-                    'type': 'html',
-                    'full_match': img_tag,
-                    'url': parser.img_src,
-                    'width': parser.img_width,
-                    'start': match.start(),
-                    'end': match.end()
-                })
-    
-    # 按位置排序，从后往前处理避免位置偏移
-    images.sort(key=lambda x: x['start'], reverse=True)
-    return images
-
-def process_markdown_article(markdown_text):
+def process_markdown_article(markdown_text, key_mode=None, on_event=None, cancel_event=None, optimize=None,
+                             srcset=False, deadline=None):
     """
     处理markdown文章中的所有图片
+    on_event 为可选的回调，每个图片状态变化时以事件字典调用
+    （start / queued / skipped / downloading / uploaded / failed）
+    cancel_event 被设置后，尚未开始的图片不再处理
+    optimize 指定时，带 width 属性的图片会缩放到该宽度
+    srcset 为 True 时每个图片生成多个尺寸，替换为带 srcset 属性的img标签
+    同一篇文章（内容和选项都相同）再次处理时，进度日志中已成功的图片直接沿用之前的结果
+    重复出现的图片只传输一次；已在本存储桶或不在允许域名内的图片保持原样
+    deadline 为整篇文章的截止时间（deadline.Deadline）：到期时不再等待未完成的图片，
+    返回已完成的部分结果（partial 为 True），未完成的图片保持原链接，计入失败
     """
     print("开始处理markdown文章...")
+    key_mode = resolve_key_mode(key_mode)
+    optimize = resolve_optimize(optimize)
     images = extract_images_from_markdown(markdown_text)
+    emit = on_event or (lambda event: None)
     
     if not images:
         return {
@@ -178,37 +168,109 @@ def process_markdown_article(markdown_text):
         }
     
     print(f"发现 {len(images)} 个图片，开始处理...")
-    processed_text = markdown_text
-    processed_count = 0
-    failed_images = []
-    
-    for i, img_info in enumerate(images):
-        print(f"\n--- 处理第 {i+1} 个图片: {img_info['url']} ---")
-        new_url = upload_single_image(img_info['url'])
-        
+    journal = get_journal()
+    document = document_key(markdown_text, key_mode=key_mode, optimize=optimize, srcset=bool(srcset))
+    new_urls = (journal.results(document, [img_info['url'] for img_info in images])
+                if journal else [None] * len(images))
+    resumed_count = sum(1 for new_url in new_urls if new_url)
+
+    # 传输计划：重复的图片合并为一次传输，已托管或被域名规则排除的图片跳过
+    transfers, skipped = plan_transfers(
+        [(index, img_info['url'], img_info.get('width'))
+         for index, img_info in enumerate(images) if not new_urls[index]],
+        hosted_prefixes(), per_width=bool(optimize or srcset)
+    )
+    planned_bytes = (size_transfers(transfers, get_http_session(), deadline)
+                     if PLAN_HEAD_REQUESTS and transfers else None)
+    pending_count = sum(len(item['positions']) for item in transfers)
+    if pending_count > len(transfers):
+        print(f"♻️ {pending_count} 个图片合并为 {len(transfers)} 次传输")
+    if skipped:
+        print(f"⏭️ 跳过 {len(skipped)} 个无需转存的图片")
+
+    start_event = {'event': 'start', 'total': len(images), 'transfers': len(transfers), 'skipped': len(skipped)}
+    if planned_bytes is not None:
+        start_event['planned_bytes'] = planned_bytes
+    emit(start_event)
+    for index, img_info in enumerate(images):
+        emit({'event': 'queued', 'index': index, 'url': describe_url(img_info['url'])})
+    for index, img_info in enumerate(images):
+        if new_urls[index]:
+            emit({'event': 'uploaded', 'index': index, 'url': describe_url(img_info['url']), 'bytes': 0, 'elapsed_ms': 0,
+                  'new_url': new_urls[index], 'cached': True, 'resumed': True})
+        elif index in skipped:
+            emit({'event': 'skipped', 'index': index, 'url': describe_url(img_info['url']), 'reason': skipped[index]})
+    if resumed_count:
+        print(f"♻️ 沿用上次处理的结果: {resumed_count} 个图片")
+
+    # 截止时间到期时，仍在进行的传输与结果汇总之间的互斥
+    settle_lock = threading.Lock()
+
+    def finish(item, new_url, event):
+        """
+        一次传输的结果分发给该图片出现的每个位置
+        截止时间到期后才完成的传输仍然记录进度（下次处理时沿用），但不再发送事件
+        """
+        with settle_lock:
+            late = item.get('timed_out', False)
+            item['finished'] = True
+            item['new_url'] = new_url
+            for index in item['positions']:
+                if new_url:
+                    # 每个图片成功后立即记录，进程中途退出也不会丢失进度
+                    if journal:
+                        journal.record(document, index, item['url'], new_url)
+                    if not late:
+                        emit({'event': 'uploaded', 'index': index, **event})
+                elif not late:
+                    emit({'event': 'failed', 'index': index, **event})
+        return new_url
+
+    def transfer(item):
+        url = item['url']
+        # 事件中的URL用于显示，data URI 只保留开头
+        label = describe_url(url)
+        if cancel_event is not None and cancel_event.is_set():
+            return finish(item, None, {'url': label, 'bytes': 0, 'elapsed_ms': 0, 'error': '任务已取消'})
+        if item['error']:
+            return finish(item, None, {'url': label, 'bytes': 0, 'elapsed_ms': 0, 'error': item['error']})
+        for index in item['positions']:
+            emit({'event': 'downloading', 'index': index, 'url': label})
+        started = time.monotonic()
+        stats = {}
+        new_url = upload_single_image(url, key_mode, stats, optimize, item['width'], srcset, deadline)
+        event = {
+            'url': label,
+            'bytes': stats.get('bytes', 0),
+            'elapsed_ms': round((time.monotonic() - started) * 1000)
+        }
         if new_url:
-            # 替换原来的图片标签
-            if img_info['type'] == 'markdown':
-                # 替换markdown语法
-                new_tag = f"![{img_info['alt']}]({new_url})"
-            elif img_info['type'] == 'a_img':
-                # 替换包含在a标签中的img标签，去掉整个a标签
-                width_attr = f' width="{img_info["width"]}"' if img_info.get('width') else ''
-                new_tag = f'<img src="{new_url}"{width_attr} />'
-            else: # html img tag
-                # 替换HTML img标签
-                width_attr = f' width="{img_info["width"]}"' if img_info.get('width') else ''
-                new_tag = f'<img src="{new_url}"{width_attr} />'
-            
-            # 从后往前替换，避免位置偏移
-            processed_text = (
-                processed_text[:img_info['start']] + 
-                new_tag + 
-                processed_text[img_info['end']:]
-            )
-            processed_count += 1
+            event.update(new_url=new_url, cached=stats.get('cached', False))
         else:
-            failed_images.append(img_info['url'])
+            event['error'] = stats.get('error', '未知错误')
+        return finish(item, new_url, event)
+    
+    # 并发下载并上传尚未完成的图片，到达截止时间后不再等待
+    run_concurrent(transfer, transfers, url_of=lambda item: item['url'], deadline=deadline)
+    timed_out_count = 0
+    with settle_lock:
+        for item in transfers:
+            if not item.get('finished'):
+                item['timed_out'] = True
+                timed_out_count += len(item['positions'])
+                for index in item['positions']:
+                    emit({'event': 'failed', 'index': index, 'url': describe_url(item['url']), 'bytes': 0,
+                          'elapsed_ms': 0, 'error': '已超过截止时间'})
+            for index in item['positions']:
+                new_urls[index] = item.get('new_url')
+    if timed_out_count:
+        print(f"⏰ 已到达截止时间，{timed_out_count} 个图片未完成，返回部分结果")
+
+    # 所有传输完成后再统一替换文本，保证结果确定
+    processed_text = rewrite_markdown(markdown_text, images, new_urls)
+    processed_count = sum(1 for new_url in new_urls if new_url)
+    failed_images = [describe_url(img_info['url']) for index, (img_info, new_url) in enumerate(zip(images, new_urls))
+                     if not new_url and index not in skipped]
     
     result = {
         'success': True,
@@ -217,17 +279,82 @@ def process_markdown_article(markdown_text):
         'total_count': len(images)
     }
     
+    if resumed_count:
+        result['resumed_count'] = resumed_count
+    
+    if skipped:
+        result['skipped_count'] = len(skipped)
+    
+    if timed_out_count:
+        result['partial'] = True
+        result['timed_out_count'] = timed_out_count
+    
     if failed_images:
         result['message'] = f"成功处理 {processed_count} 个图片，{len(failed_images)} 个失败"
+        if timed_out_count:
+            result['message'] += f"（其中 {timed_out_count} 个超过截止时间）"
         result['failed_images'] = failed_images
     else:
         result['message'] = f"成功处理所有 {processed_count} 个图片"
+        if skipped:
+            result['message'] += f"，跳过 {len(skipped)} 个无需转存的图片"
+        if journal:
+            journal.forget(document)
     
     return result
 
+def run_article_job(payload, on_event, cancel_event):
+    """
+    后台任务的处理函数
+    """
+    return process_markdown_article(
+        payload['markdown'], payload.get('key_mode'), on_event, cancel_event,
+        payload.get('optimize'), payload.get('srcset', False)
+    )
+
+# 本地源图缓存的启动清理在恢复任务、处理请求之前完成，不占用传输线程
+init_blob_cache()
+
+# 后台任务队列，启动时会恢复上次未完成的任务
+job_manager = JobManager(JobStore(JOB_STORE_PATH), run_article_job)
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', direct_upload=DIRECT_UPLOAD, hash_key_mode=resolve_key_mode() == 'hash')
+
+# 就绪检查结果的缓存时间（秒），负载均衡器频繁探测时不必每次都访问 R2
+READY_CHECK_INTERVAL = 10
+ready_state = {'checked_at': 0, 'ready': False, 'checks': {}}
+
+@app.route('/health')
+def health():
+    """
+    存活检查：进程能够响应请求即可
+    """
+    return jsonify({'status': 'ok'})
+
+@app.route('/ready')
+def ready():
+    """
+    就绪检查：R2 存储桶可以访问、任务存储可以读取，失败时返回 503
+    """
+    now = time.monotonic()
+    if now - ready_state['checked_at'] >= READY_CHECK_INTERVAL:
+        checks = {}
+        try:
+            get_s3_client().head_bucket(Bucket=BUCKET_NAME)
+            checks['r2'] = 'ok'
+        except Exception as e:
+            checks['r2'] = f'error: {e}'
+        try:
+            job_manager.get('')
+            checks['jobs'] = 'ok'
+        except Exception as e:
+            checks['jobs'] = f'error: {e}'
+        ready_state.update(checked_at=now, checks=checks,
+                           ready=all(value == 'ok' for value in checks.values()))
+    return jsonify({'ready': ready_state['ready'], 'checks': ready_state['checks']}), \
+        200 if ready_state['ready'] else 503
 
 @app.route('/process', methods=['POST'])
 def process():
@@ -240,8 +367,15 @@ def process():
                 'success': False,
                 'message': '请输入markdown内容'
             })
+
+        # 大文档可以交给后台任务处理，立即返回任务ID
+        if data.get('async'):
+            return submit_job(markdown_text, data.get('key_mode'), data.get('optimize'), bool(data.get('srcset')))
         
-        result = process_markdown_article(markdown_text)
+        result = process_markdown_article(
+            markdown_text, data.get('key_mode'), optimize=data.get('optimize'), srcset=bool(data.get('srcset')),
+            deadline=request_deadline(data.get('deadline'))
+        )
         return jsonify(result)
         
     except Exception as e:
@@ -250,40 +384,372 @@ def process():
             'message': f'处理出错: {str(e)}'
         })
 
+# 流式处理时攒够多少字符再发送给客户端
+PROCESS_FILE_FLUSH_SIZE = 64 * 1024
+
+@app.route('/process_file', methods=['POST'])
+def process_file():
+    """
+    超大markdown文件的流式处理：以表单上传文件，服务器分块读取、并发上传图片，
+    改写后的内容按原顺序边处理边以附件形式返回，不把整篇文档读入内存
+    选项通过查询参数或表单字段传入：key_mode / optimize / srcset
+    """
+    try:
+        if 'file' not in request.files:
+            return jsonify({'success': False, 'message': 'No file part'})
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'success': False, 'message': 'No selected file'})
+
+        options = request.args.to_dict()
+        options.update(request.form.to_dict())
+        key_mode = resolve_key_mode(options.get('key_mode'))
+        optimize = resolve_optimize(options.get('optimize'))
+        srcset = options.get('srcset', '').lower() in ('1', 'true', 'yes')
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'处理出错: {str(e)}'})
+
+    # 响应头发出后无法再返回错误，不是合法 UTF-8 的字节以 surrogateescape 原样读入、原样写出
+    reader = io.TextIOWrapper(file.stream, encoding='utf-8', errors='surrogateescape', newline='')
+    summary = {}
+
+    def encode(text):
+        return text.encode('utf-8', 'surrogateescape')
+
+    def generate():
+        buffered = []
+        buffered_size = 0
+        pieces = rewrite_markdown_stream(
+            reader,
+            lambda url, width: upload_single_image(url, key_mode, None, optimize, width, srcset),
+            summary, hosted_prefixes(), per_width=bool(optimize or srcset)
+        )
+        for piece in pieces:
+            buffered.append(piece)
+            buffered_size += len(piece)
+            if buffered_size >= PROCESS_FILE_FLUSH_SIZE:
+                yield encode(''.join(buffered))
+                buffered = []
+                buffered_size = 0
+        yield encode(''.join(buffered))
+        print(f"🎉 流式处理完成: 共 {summary['total']} 个图片，成功 {summary['processed']} 个，"
+              f"跳过 {summary['skipped']} 个，失败 {summary['failed']} 个")
+
+    name = secure_filename(file.filename) or 'document.md'
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/markdown; charset=utf-8',
+        headers={'Content-Disposition': f'attachment; filename="processed-{name}"'}
+    )
+
+def submit_job(markdown_text, key_mode, optimize=None, srcset=False):
+    resolve_key_mode(key_mode)
+    resolve_optimize(optimize)
+    job_id = job_manager.submit({
+        'markdown': markdown_text, 'key_mode': key_mode, 'optimize': optimize, 'srcset': srcset
+    })
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'message': '任务已提交'
+    }), 202
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    try:
+        data = request.get_json()
+        markdown_text = data.get('markdown', '')
+
+        if not markdown_text.strip():
+            return jsonify({
+                'success': False,
+                'message': '请输入markdown内容'
+            })
+
+        return submit_job(markdown_text, data.get('key_mode'), data.get('optimize'), bool(data.get('srcset')))
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'提交任务出错: {str(e)}'
+        })
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    return jsonify({'success': True, 'job': job_to_dict(job)})
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    if job['result'] is None:
+        return jsonify({'success': False, 'status': job['status'], 'message': '任务尚未完成'}), 409
+    return jsonify(job['result'])
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if job_manager.get(job_id) is None:
+        return jsonify({'success': False, 'message': '任务不存在'}), 404
+    if not job_manager.cancel(job_id):
+        return jsonify({'success': False, 'message': '任务已结束，无法取消'}), 409
+    return jsonify({'success': True, 'message': '已取消任务'})
+
+# 流式接口在没有新事件时发送心跳的间隔（秒），避免代理因空闲断开连接
+STREAM_HEARTBEAT_INTERVAL = 15
+
+@app.route('/process_stream', methods=['POST'])
+def process_stream():
+    """
+    /process 的流式版本，以 NDJSON 格式逐行返回每个图片的处理事件，
+    最后一行为 done 事件，携带与 /process 相同的结果
+    """
+    data = request.get_json()
+    markdown_text = data.get('markdown', '')
+    key_mode = data.get('key_mode')
+    optimize = data.get('optimize')
+    srcset = bool(data.get('srcset'))
+
+    if not markdown_text.strip():
+        return jsonify({
+            'success': False,
+            'message': '请输入markdown内容'
+        })
+
+    deadline = request_deadline(data.get('deadline'))
+    events = queue.Queue()
+
+    def worker():
+        try:
+            result = process_markdown_article(markdown_text, key_mode, events.put, optimize=optimize, srcset=srcset,
+                                              deadline=deadline)
+        except Exception as e:
+            result = {'success': False, 'message': f'处理出错: {str(e)}'}
+        events.put({'event': 'done', 'result': result})
+
+    def generate():
+        threading.Thread(target=worker, daemon=True).start()
+        while True:
+            try:
+                event = events.get(timeout=STREAM_HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                event = {'event': 'heartbeat'}
+            yield json.dumps(event, ensure_ascii=False) + '\n'
+            if event['event'] == 'done':
+                break
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def finish_streamed_upload(writer, filename, key_mode, stats=None):
+    """
+    完成分片上传并返回对象名；hash 模式下改为按内容摘要命名
+    内容在接收时已全部上传，hash 模式只能避免重复保存，不能像 put_stream 那样省去重复内容的上传
+    """
+    if stats is not None:
+        stats['bytes'] = writer.size
+    with stage(stats, 'upload'):
+        writer.complete()
+        if resolve_key_mode(key_mode) == 'hash':
+            return adopt_content_key(
+                get_s3_client(),
+                BUCKET_NAME,
+                writer.key,
+                writer.sha256,
+                file_extension(filename),
+                writer.content_type
+            )
+    return writer.key
+
+def upload_optimized_file(file, key_mode, optimize, width=None, stats=None):
+    """
+    优化本地上传的图片后再上传，无法优化的文件按原样上传
+    表单解析时文件已暂存（超过 500KB 写入磁盘），这里读入内存前先检查大小并申请内存预算
+    """
+    size = file.stream.seek(0, io.SEEK_END)
+    file.stream.seek(0)
+    check_size(size)
+    with get_byte_budget().reserve(size):
+        data = file.read()
+        content_type = file.content_type
+        extension = file_extension(file.filename)
+        if stats is not None:
+            stats['bytes'] = len(data)
+        with stage(stats, 'process'):
+            optimized = optimize_image(data, resolve_optimize(optimize), width)
+        if optimized:
+            data, content_type, extension = optimized
+            if stats is not None:
+                stats['optimized_bytes'] = len(data)
+        return put_stream(get_s3_client(), BUCKET_NAME, io.BytesIO(data), extension, content_type, key_mode, stats)
+
 @app.route('/upload_local', methods=['POST'])
 def upload_local():
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'message': 'No file part'})
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'success': False, 'message': 'No selected file'})
-    if file:
-        try:
-            # Create downloads directory if not exists
-            os.makedirs('downloads', exist_ok=True)
-            
-            filename = f"{uuid.uuid4()}{os.path.splitext(file.filename)[1]}"
-            
-            # Save the file to a temporary location
-            temp_path = os.path.join('downloads', filename)
-            file.save(temp_path)
-
-            # Upload to R2
-            with open(temp_path, 'rb') as file_obj:
-                client.upload_fileobj(
-                    file_obj,
-                    BUCKET_NAME,
-                    filename,
-                    ExtraArgs={'ACL': 'public-read', 'ContentType': file.content_type}
+    try:
+        if 'file' not in request.files:
+            return jsonify({'success': False, 'message': 'No file part'})
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'success': False, 'message': 'No selected file'})
+
+        key_mode = request.args.get('key_mode') or request.form.get('key_mode')
+        if isinstance(file.stream, MultipartUploadWriter):
+            # The request body has already been streamed to R2 in parts while
+            # the form was parsed; only the multipart upload is left to complete
+            filename = observed(
+                file.filename, None,
+                lambda stats: finish_streamed_upload(file.stream, file.filename, key_mode, stats)
+            )
+        else:
+            filename = observed(
+                file.filename, None,
+                lambda stats: upload_optimized_file(
+                    file, key_mode, request.args.get('optimize'), request.form.get('width'), stats
                 )
-            
-            # Clean up the temporary file
-            os.remove(temp_path)
+            )
+        return jsonify({'success': True, 'url': public_url(filename)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Upload failed: {str(e)}'})
+    finally:
+        # 未完成的分片上传（多余的文件字段、出错中断等）全部取消
+        for writer in request.upload_writers:
+            writer.abort()
+
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    """
+    批量上传：一个 multipart 请求包含多个 files 字段，并发上传到R2，返回每个文件的结果
+    文件边接收边上传，前一个文件接收完后在后台完成上传，同时继续接收下一个文件
+    """
+    key_mode = request.args.get('key_mode')
+    optimize = request.args.get('optimize')
+    try:
+        files = request.files.getlist('files')
+        parse_error = None
+    except Exception as e:
+        # 表单中途出错（如某个文件超过上限）时，之前已经接收完的文件仍然正常完成
+        files = []
+        parse_error = e
 
-            public_url = f"{CUSTOM_DOMAIN}/{filename}"
-            return jsonify({'success': True, 'url': public_url})
-        except Exception as e:
-            return jsonify({'success': False, 'message': f'Upload failed: {str(e)}'})
+    results = []
+    try:
+        if request.batch_uploads:
+            for entry in request.batch_uploads:
+                result = {'filename': entry['filename']}
+                try:
+                    if parse_error is not None and entry['future'] is None:
+                        # 出错时正在接收的文件，内容不完整
+                        raise parse_error
+                    key = request.finish_batch_upload(entry).result()
+                    result.update({'success': True, 'url': public_url(key)})
+                except Exception as e:
+                    result.update({'success': False, 'message': f'Upload failed: {str(e)}'})
+                results.append(result)
+        elif files:
+            # 需要优化的图片已由表单解析器暂存，并发优化后上传
+            def upload_file(file):
+                try:
+                    key = observed(
+                        file.filename, None,
+                        lambda stats: upload_optimized_file(file, key_mode, optimize, None, stats)
+                    )
+                    return {'filename': file.filename, 'success': True, 'url': public_url(key)}
+                except Exception as e:
+                    return {'filename': file.filename, 'success': False, 'message': f'Upload failed: {str(e)}'}
+
+            results = run_concurrent(upload_file, files, url_of=lambda file: None,
+                                     max_workers=BATCH_UPLOAD_WORKERS, per_host=BATCH_UPLOAD_WORKERS)
+        elif parse_error is not None:
+            return jsonify({'success': False, 'message': f'Upload failed: {str(parse_error)}'})
+        else:
+            return jsonify({'success': False, 'message': 'No file part'})
+    finally:
+        # 未完成的分片上传全部取消
+        for writer in request.upload_writers:
+            writer.abort()
+
+    uploaded = sum(1 for result in results if result['success'])
+    message = f"成功上传 {uploaded} 个文件，{len(results) - uploaded} 个失败"
+    if parse_error is not None:
+        message += f"（请求中断: {str(parse_error)}）"
+    return jsonify({
+        'success': True,
+        'message': message,
+        'uploaded': uploaded,
+        'failed': len(results) - uploaded,
+        'results': results
+    })
+
+@app.route('/upload_presign', methods=['POST'])
+def upload_presign():
+    """
+    浏览器直传第一步：签发上传到存储桶的预签名 PUT 地址，文件内容不再经过本服务
+    请求体为 {filename, content_type, size, sha256, key_mode}；hash 模式下对象已存在时直接返回链接
+    返回 direct: false 表示该文件应改用 /upload_local 上传
+    """
+    try:
+        data = request.get_json() or {}
+        filename = data.get('filename', '')
+        content_type = data.get('content_type', '')
+        digest = (data.get('sha256') or '').lower()
+        key_mode = resolve_key_mode(data.get('key_mode'))
+        size = int(data.get('size') or 0)
+        # 需要在服务端优化的图片、非图片文件、未提供大小，以及 hash 模式下缺少摘要时仍由服务端上传
+        # 只看是否设置了 OPTIMIZE_FORMAT：未安装 Pillow 等配置问题由 /upload_local 报告，这里只负责回退
+        if (not DIRECT_UPLOAD or optimize_requested() or not content_type.startswith('image/') or size <= 0
+                or (key_mode == 'hash' and not digest)):
+            return jsonify({'success': False, 'direct': False, 'message': '该文件不使用直传'})
+        if not filename:
+            return jsonify({'success': False, 'message': 'No selected file'})
+        if digest and not re.fullmatch(r'[0-9a-f]{64}', digest):
+            return jsonify({'success': False, 'message': 'sha256 格式不正确'})
+        check_size(size)
+
+        client = get_s3_client()
+        if key_mode == 'hash':
+            key = f"{digest}{file_extension(filename)}"
+            if object_exists(client, BUCKET_NAME, key):
+                return jsonify({'success': True, 'exists': True, 'key': key, 'url': public_url(key)})
+        else:
+            key = f"{uuid.uuid4()}{file_extension(filename)}"
+        upload_url, headers = presign_put(client, BUCKET_NAME, key, content_type, size, digest or None)
+        return jsonify({
+            'success': True,
+            'method': 'PUT',
+            'upload_url': upload_url,
+            'headers': headers,
+            'key': key,
+            'expires_in': PRESIGN_EXPIRES
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Presign failed: {str(e)}'})
+
+@app.route('/upload_confirm', methods=['POST'])
+def upload_confirm():
+    """
+    浏览器直传第二步：文件上传到存储桶后确认，检查对象并返回公开链接
+    """
+    try:
+        key = (request.get_json() or {}).get('key', '')
+        if not key:
+            return jsonify({'success': False, 'message': '缺少 key'})
+        observed(key, None, lambda stats: confirm_direct_upload(get_s3_client(), BUCKET_NAME, key, stats))
+        return jsonify({'success': True, 'url': public_url(key)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Upload failed: {str(e)}'})
+
+@app.route('/metrics')
+def metrics():
+    """
+    Prometheus 指标：图片数（按结果分类）、总耗时与各阶段耗时直方图、传输字节数
+    """
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/console_process', methods=['POST'])
 def console_process():
@@ -298,7 +764,8 @@ def console_process():
             })
         
         # 处理单个图片输入（类似upload.py的逻辑）
-        result = process_single_input(user_input)
+        result = process_single_input(user_input, data.get('key_mode'), data.get('optimize'),
+                                      request_deadline(data.get('deadline')))
         
         if result.startswith('❌'):
             return jsonify({
@@ -317,7 +784,7 @@ def console_process():
             'message': f'处理出错: {str(e)}'
         })
 
-def process_single_input(input_text):
+def process_single_input(input_text, key_mode=None, optimize=None, deadline=None):
     """
     处理单个输入（URL或HTML标签），返回处理后的img标签
     """
@@ -333,7 +800,8 @@ def process_single_input(input_text):
         if not parser.img_src:
             return "❌ 未找到有效的img src"
         image_url = parser.img_src
-        width_attr = f' width="{parser.img_width}"' if parser.img_width else ''
+        width = parser.img_width
+        width_attr = f' width="{width}"' if width else ''
     elif '<img' in stripped_input:
         # 输入包含HTML，提取img标签
         img_tag_match = re.search(r'<img\s+[^>]*>', stripped_input, re.IGNORECASE)
@@ -345,48 +813,19 @@ def process_single_input(input_text):
         if not parser.img_src:
             return "❌ 未找到有效的img src"
         image_url = parser.img_src
-        width_attr = f' width="{parser.img_width}"' if parser.img_width else ''
+        width = parser.img_width
+        width_attr = f' width="{width}"' if width else ''
     else:
         # 假设是直接的URL
         image_url = stripped_input
+        width = None
         width_attr = ''
 
     # 上传图片
     try:
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status()
-
-        # 确保downloads目录存在
-        os.makedirs('downloads', exist_ok=True)
-
-        # 生成随机文件名
-        original_filename = os.path.basename(image_url.split('?')[0])
-        file_extension = os.path.splitext(original_filename)[1]
-        if not file_extension:
-            file_extension = '.jpg'  # 默认扩展名
-        random_filename = f"{uuid.uuid4()}{file_extension}"
-        filename = random_filename
-
-        # 本地保存
-        local_path = os.path.join('downloads', filename)
-        with open(local_path, 'wb') as f:
-            f.write(response.content)
-
-        # 上传到R2
-        with open(local_path, 'rb') as file_obj:
-            client.upload_fileobj(
-                file_obj,
-                BUCKET_NAME,
-                filename,
-                ExtraArgs={'ACL': 'public-read', 'ContentType': response.headers.get('Content-Type', 'image/jpeg')}
-            )
-
-        # 清理本地文件
-        os.remove(local_path)
-
-        # 构建公开URL
-        public_url = f"{CUSTOM_DOMAIN}/{filename}"
-        return f"<img src=\"{public_url}\"{width_attr} />"
+        # 流式上传到R2（优先复用URL缓存），没有扩展名时默认使用 .jpg
+        new_url = upload_image(image_url, '.jpg', key_mode, optimize=optimize, width=width, deadline=deadline)
+        return f"<img src=\"{new_url}\"{width_attr} />"
 
     except requests.exceptions.RequestException as e:
         return f"❌ 下载图片失败: {e}"
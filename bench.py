@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线性能基准
+
+在本机启动模拟的 S3 服务（moto）和图片服务器，用合成的文章和文件测试
+process_markdown_article、/upload_local 和命令行 upload.process_input 三条路径，
+输出每秒处理图片数、p50/p99 延迟和峰值内存（RSS）。
+
+每个场景在独立的子进程中运行，峰值内存互不影响。
+依赖: pip install "moto[server]"
+
+用法:
+    python bench.py
+    python bench.py --images 10,100 --sizes 50k,2m --latency 0,100 --targets markdown,cli
+"""
+import os
+import io
+import sys
+import json
+import math
+import logging
+import time
+import socket
+import argparse
+import threading
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_TARGETS = ('markdown', 'upload_local', 'cli')
+BENCH_BUCKET = 'bench'
+BENCH_DOMAIN = 'https://bench.invalid'
+
+# JPEG 文件头，后面填充随机数据，足以让服务按图片处理
+_JPEG_HEADER = b'\xff\xd8\xff\xe0'
+_payloads = {}
+_payloads_lock = threading.Lock()
+
+
+def parse_size(text):
+    """
+    解析 50k / 2m / 1024 这类大小
+    """
+    text = text.strip().lower()
+    units = {'k': 1024, 'm': 1024 * 1024}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    if size >= 1024 * 1024:
+        return f"{size / 1024 / 1024:g}M"
+    if size >= 1024:
+        return f"{size / 1024:g}K"
+    return str(size)
+
+
+def synthetic_image(size):
+    """
+    生成指定大小的合成图片数据，同一大小只生成一次
+    """
+    with _payloads_lock:
+        if size not in _payloads:
+            _payloads[size] = _JPEG_HEADER + os.urandom(max(0, size - len(_JPEG_HEADER)))
+        return _payloads[size]
+
+
+def percentile(values, pct):
+    """
+    最近秩法计算百分位数
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def peak_rss_mb():
+    """
+    当前进程的峰值内存（MB），不支持的平台返回 None
+    """
+    # Linux 的 ru_maxrss 会继承自父进程（fork + exec 后不重置），优先读取本进程的 VmHWM
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位为 KB，macOS 上为字节
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """
+    合成图片服务：/img/<编号>.jpg?size=字节数&latency=毫秒
+    latency 模拟源站的首字节延迟
+    """
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        size = int(query.get('size', ['51200'])[0])
+        latency = float(query.get('latency', ['0'])[0])
+        if latency:
+            time.sleep(latency / 1000)
+        data = synthetic_image(size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_image_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_s3_server():
+    """
+    启动进程内的 moto S3 服务并创建测试用的存储桶
+    """
+    try:
+        import boto3
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        print("❌ 基准测试需要安装 moto: pip install \"moto[server]\"")
+        raise SystemExit(1)
+
+    # moto 使用 werkzeug 提供服务，关闭逐请求的访问日志
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+    boto3.client(
+        's3', region_name='us-east-1', endpoint_url=endpoint,
+        aws_access_key_id='bench', aws_secret_access_key='bench'
+    ).create_bucket(Bucket=BENCH_BUCKET)
+    return server, endpoint
+
+
+def image_urls(image_base, scenario, prefix):
+    return [
+        f"{image_base}/img/{prefix}{i}.jpg?size={scenario['size']}&latency={scenario['latency']}"
+        for i in range(scenario['images'])
+    ]
+
+
+def bench_markdown(scenario, image_base):
+    import app
+
+    urls = image_urls(image_base, scenario, 'md')
+    markdown_text = '\n\n'.join(f"![图片{i}]({url})" for i, url in enumerate(urls))
+    latencies = []
+
+    def on_event(event):
+        if event['event'] == 'uploaded':
+            latencies.append(event['elapsed_ms'])
+
+    started = time.monotonic()
+    result = app.process_markdown_article(markdown_text, scenario.get('key_mode'), on_event)
+    return time.monotonic() - started, latencies, result['processed_count']
+
+
+def bench_upload_local(scenario, image_base):
+    import app
+    from pipeline import MAX_WORKERS
+
+    data = synthetic_image(scenario['size'])
+    test_client = app.app.test_client()
+    query = f"?key_mode={scenario['key_mode']}" if scenario.get('key_mode') else ''
+
+    def post(index):
+        started = time.monotonic()
+        response = test_client.post(
+            '/upload_local' + query,
+            data={'file': (io.BytesIO(data), f"local{index}.jpg")},
+            content_type='multipart/form-data'
+        )
+        elapsed_ms = round((time.monotonic() - started) * 1000)
+        return elapsed_ms if response.get_json().get('success') else None
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(post, range(scenario['images'])))
+    latencies = [result for result in results if result is not None]
+    return time.monotonic() - started, latencies, len(latencies)
+
+
+def bench_cli(scenario, image_base):
+    import upload
+
+    latencies = []
+    latencies_lock = threading.Lock()
+    upload_image_with_width = upload.upload_image_with_width
+
+    # 包装单张图片的处理函数以记录每张图片的耗时
+    def timed(image_url, width, key_mode=None):
+        started = time.monotonic()
+        result = upload_image_with_width(image_url, width, key_mode)
+        if result:
+            with latencies_lock:
+                latencies.append(round((time.monotonic() - started) * 1000))
+        return result
+
+    upload.upload_image_with_width = timed
+    html = '\n'.join(f'<img src="{url}" width="600">' for url in image_urls(image_base, scenario, 'cli'))
+    started = time.monotonic()
+    try:
+        upload.process_input(html, scenario.get('key_mode'))
+    finally:
+        upload.upload_image_with_width = upload_image_with_width
+    return time.monotonic() - started, latencies, len(latencies)
+
+
+BENCH_FUNCTIONS = {
+    'markdown': bench_markdown,
+    'upload_local': bench_upload_local,
+    'cli': bench_cli,
+}
+
+
+def run_worker(scenario, image_base):
+    """
+    子进程入口：先预热一张图片，再运行场景，最后一行输出 JSON 结果
+    """
+    bench = BENCH_FUNCTIONS[scenario['target']]
+    # 服务本身的日志输出量很大，基准测试期间丢弃
+    with contextlib.redirect_stdout(io.StringIO()):
+        bench(dict(scenario, images=1), image_base)
+        elapsed, latencies, succeeded = bench(scenario, image_base)
+    print(json.dumps({
+        **scenario,
+        'succeeded': succeeded,
+        'failed': scenario['images'] - succeeded,
+        'seconds': round(elapsed, 3),
+        'images_per_second': round(succeeded / elapsed, 2) if elapsed else None,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'peak_rss_mb': peak_rss_mb()
+    }))
+
+
+def run_scenario(scenario, image_base, env):
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', json.dumps(scenario), '--image-base', image_base],
+        env=env, capture_output=True, text=True
+    )
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        print(f"❌ 场景运行失败: {scenario}\n{completed.stderr.strip()}")
+        return None
+    return json.loads(lines[-1])
+
+
+def print_report(results):
+    header = f"{'路径':<14}{'图片数':>8}{'大小':>8}{'延迟ms':>8}{'图片/秒':>10}{'p50ms':>8}{'p99ms':>8}{'峰值RSS MB':>12}{'失败':>6}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(
+            f"{result['target']:<14}{result['images']:>8}{format_size(result['size']):>8}{result['latency']:>8g}"
+            f"{result['images_per_second'] or '-':>10}{result['p50_ms'] or '-':>8}{result['p99_ms'] or '-':>8}"
+            f"{result['peak_rss_mb'] or '-':>12}{result['failed']:>6}"
+        )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="离线性能基准（moto S3 + 本地图片服务器）")
+    arg_parser.add_argument('--targets', default=','.join(BENCH_TARGETS),
+                            help=f"要测试的路径，逗号分隔（默认 {','.join(BENCH_TARGETS)}）")
+    arg_parser.add_argument('--images', default='10,50', help="每个场景的图片数，逗号分隔")
+    arg_parser.add_argument('--sizes', default='50k,1m', help="单张图片大小，逗号分隔，支持 k/m 后缀")
+    arg_parser.add_argument('--latency', default='0,50', help="源站首字节延迟（毫秒），逗号分隔")
+    arg_parser.add_argument('--key-mode', default=None, help="对象命名方式，uuid 或 hash")
+    arg_parser.add_argument('--json', metavar='PATH', help="将结果写入 JSON 文件")
+    arg_parser.add_argument('--worker', help=argparse.SUPPRESS)
+    arg_parser.add_argument('--image-base', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.worker:
+        run_worker(json.loads(args.worker), args.image_base)
+        return
+
+    targets = [target.strip() for target in args.targets.split(',') if target.strip()]
+    unknown = set(targets) - set(BENCH_TARGETS)
+    if unknown:
+        arg_parser.error(f"未知的路径: {', '.join(sorted(unknown))}")
+
+    image_server, image_base = start_image_server()
+    s3_server, endpoint = start_s3_server()
+    env = dict(
+        os.environ,
+        ACCESS_KEY_ID='bench',
+        SECRET_ACCESS_KEY='bench',
+        ENDPOINT_URL=endpoint,
+        BUCKET_NAME=BENCH_BUCKET,
+        CUSTOM_DOMAIN=BENCH_DOMAIN,
+        # 关闭URL缓存、本地源图缓存和进度日志，每次都真实下载，不在工作目录写入文件；任务队列不落盘
+        URL_CACHE_PATH='',
+        BLOB_CACHE_DIR='',
+        JOURNAL_PATH='',
+        JOB_STORE_PATH=':memory:'
+    )
+    print(f"🚀 S3: {endpoint}  图片服务器: {image_base}")
+
+    results = []
+    try:
+        for target in targets:
+            # 本地上传不经过源站，延迟参数对它没有意义
+            latencies = [0] if target == 'upload_local' else [float(v) for v in args.latency.split(',')]
+            for images in [int(v) for v in args.images.split(',')]:
+                for size in [parse_size(v) for v in args.sizes.split(',')]:
+                    for latency in latencies:
+                        scenario = {'target': target, 'images': images, 'size': size,
+                                    'latency': latency, 'key_mode': args.key_mode}
+                        print(f"⏱️ {target} 图片数={images} 大小={format_size(size)} 延迟={latency:g}ms")
+                        result = run_scenario(scenario, image_base, env)
+                        if result:
+                            results.append(result)
+    finally:
+        image_server.shutdown()
+        s3_server.stop()
+
+    print()
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n✅ 结果已写入 {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+
+# 源图片内容的本地缓存：上传失败重试、同一源图按不同选项再次上传时直接读本地文件，不再重新下载
+# 默认关闭（下载的内容只在内存中流式转发，不落盘）；设置 BLOB_CACHE_DIR 为目录（如 blob_cache）开启
+BLOB_CACHE_DIR = os.getenv('BLOB_CACHE_DIR', '')
+# 缓存占用的磁盘上限（字节），超出时按最近使用时间淘汰
+BLOB_CACHE_MAX_BYTES = int(os.getenv('BLOB_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+# 缓存内容的有效期（秒），过期后重新下载
+BLOB_CACHE_TTL = int(os.getenv('BLOB_CACHE_TTL', '3600'))
+
+# 单个文件超过总上限的该比例时不缓存，避免一个大文件把其他内容全部挤出
+_MAX_ENTRY_FRACTION = 0.25
+# 淘汰时清理到总上限的该比例，避免每次写入都扫描目录
+_EVICT_TARGET = 0.9
+# 未完成的临时文件超过该时间（秒）视为写入中断，启动清理时删除
+_STALE_TEMP_AGE = 3600
+
+BLOB_SUFFIX = '.blob'
+TEMP_SUFFIX = '.tmp'
+
+
+class BlobResponse:
+    """
+    从本地缓存读取的源图片，接口与 requests 的流式响应相同（status_code / headers / raw / close）
+    """
+    status_code = 200
+
+    def __init__(self, fileobj, meta, size):
+        self.raw = fileobj
+        self.headers = {'Content-Length': str(size)}
+        if meta.get('content_type'):
+            self.headers['Content-Type'] = meta['content_type']
+
+    def close(self):
+        self.raw.close()
+
+
+class _TeeReader:
+    """
+    读取源站响应的同时写入临时文件，读到结尾后提交到缓存
+    """
+    def __init__(self, cache, url, response):
+        self._cache = cache
+        self._url = url
+        self._raw = response.raw
+        self._size = 0
+        self._temp_path = cache.temp_path()
+        self._file = open(self._temp_path, 'wb')
+        meta = {'url': url, 'content_type': response.headers.get('Content-Type'), 'fetched_at': time.time()}
+        self._file.write(json.dumps(meta).encode('utf-8') + b'\n')
+
+    def read(self, amt=None):
+        data = self._raw.read(amt)
+        if self._file is None:
+            return data
+        try:
+            if data:
+                self._file.write(data)
+                self._size += len(data)
+            if not data or amt is None or amt < 0:
+                self._commit()
+            elif self._size > self._cache.max_entry_bytes:
+                self.discard()
+        except OSError as e:
+            # 磁盘写入失败不影响传输本身
+            print(f"⚠️ 写入本地缓存失败: {e}")
+            self.discard()
+        return data
+
+    def _commit(self):
+        self._file.close()
+        self._file = None
+        self._cache.commit(self._url, self._temp_path)
+
+    def discard(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        try:
+            os.remove(self._temp_path)
+        except OSError:
+            pass
+
+
+class CachingResponse:
+    """
+    包装源站响应：raw 在读取时同时写入缓存，关闭时丢弃未读完的临时文件
+    """
+    def __init__(self, cache, url, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.raw = _TeeReader(cache, url, response)
+
+    def close(self):
+        self.raw.discard()
+        self._response.close()
+
+
+class BlobCache:
+    """
+    有磁盘上限的源图片缓存，按URL的 SHA-256 命名文件
+
+    每个文件第一行为 JSON 元数据（URL、Content-Type、下载时间），之后是原始内容。
+    写入时先写临时文件再原子改名，多个线程和进程可以共用同一个目录；
+    读取命中时更新文件的修改时间，超过上限时删除最久未使用的文件。
+    创建时不扫描目录，已有内容的占用由启动时的 sweep 统计（见 init_blob_cache）。
+    """
+    def __init__(self, directory, max_bytes=BLOB_CACHE_MAX_BYTES, ttl=BLOB_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = int(max_bytes * _MAX_ENTRY_FRACTION)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total = 0
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest() + BLOB_SUFFIX)
+
+    def temp_path(self):
+        return os.path.join(self.directory, f"{uuid.uuid4().hex}{TEMP_SUFFIX}")
+
+    def open(self, url):
+        """
+        返回缓存中未过期的内容（BlobResponse），未命中返回 None
+        """
+        path = self._path(url)
+        try:
+            fileobj = open(path, 'rb')
+        except OSError:
+            return None
+        try:
+            meta = json.loads(fileobj.readline())
+            if meta.get('url') != url or time.time() - meta['fetched_at'] > self.ttl:
+                fileobj.close()
+                return None
+            size = os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            fileobj.close()
+            return None
+        return BlobResponse(fileobj, meta, size)
+
+    def wrap(self, url, response):
+        """
+        读取源站响应时同时写入缓存；Content-Length 已超过单个文件上限时原样返回
+        """
+        try:
+            if int(response.headers.get('Content-Length', 0)) > self.max_entry_bytes:
+                return response
+            return CachingResponse(self, url, response)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 无法写入本地缓存: {e}")
+            return response
+
+    def commit(self, url, temp_path):
+        """
+        读完的临时文件原子改名为正式的缓存文件，超过上限时淘汰
+        占用统计与启动清理一样按文件大小（含元数据行）计算；覆盖已有的缓存文件时先扣除其大小
+        """
+        path = self._path(url)
+        size = os.stat(temp_path).st_size
+        with self._lock:
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(temp_path, path)
+            self._total += size - replaced
+            over = self._total > self.max_bytes
+        if over:
+            self._evict()
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((entry, stat))
+        return entries
+
+    def _evict(self):
+        """
+        按最近使用时间删除文件，直到占用降到上限的 90%；其他进程写入的文件同样计入
+        """
+        with self._lock:
+            blobs = [(stat.st_mtime, stat.st_size, entry.path) for entry, stat in self._entries()
+                     if entry.name.endswith(BLOB_SUFFIX)]
+            total = sum(size for _, size, _ in blobs)
+            target = self.max_bytes * _EVICT_TARGET
+            for _, size, path in sorted(blobs):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self._total = total
+
+    def sweep(self):
+        """
+        启动时清理：删除中断写入留下的临时文件和过期的缓存，再按上限淘汰，返回剩余占用的字节数
+        """
+        now = time.time()
+        total = 0
+        for entry, stat in self._entries():
+            if entry.name.endswith(TEMP_SUFFIX):
+                expired = now - stat.st_mtime > _STALE_TEMP_AGE
+            elif entry.name.endswith(BLOB_SUFFIX):
+                expired = now - stat.st_mtime > self.ttl
+            else:
+                continue
+            if expired:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.name.endswith(BLOB_SUFFIX):
+                total += stat.st_size
+        self._total = total
+        if total > self.max_bytes:
+            self._evict()
+        return self._total
+
+
+_blob_cache = None
+_blob_cache_lock = threading.Lock()
+
+
+def get_blob_cache():
+    """
+    返回全局本地缓存实例，未配置 BLOB_CACHE_DIR 时返回 None
+    """
+    global _blob_cache
+    if not BLOB_CACHE_DIR:
+        return None
+    with _blob_cache_lock:
+        if _blob_cache is None:
+            _blob_cache = BlobCache(BLOB_CACHE_DIR)
+        return _blob_cache
+
+
+def init_blob_cache():
+    """
+    启动时调用一次：创建全局本地缓存并执行启动清理，不在传输线程中扫描目录
+    未配置 BLOB_CACHE_DIR 时返回 None
+    """
+    cache = get_blob_cache()
+    if cache is not None:
+        cache.sweep()
+    return cache
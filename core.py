@@ -0,0 +1,198 @@
+import os
+import time
+import threading
+import boto3
+import requests
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+from transfer import mirror_url, mirror_variants
+from optimize import resolve_optimize, responsive_targets, SRCSET_SIZES
+from metrics import observe_image
+from data_uri import describe_url
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量读取 Cloudflare R2 配置
+ACCESS_KEY_ID = os.getenv('ACCESS_KEY_ID')
+SECRET_ACCESS_KEY = os.getenv('SECRET_ACCESS_KEY')
+ENDPOINT_URL = os.getenv('ENDPOINT_URL')
+BUCKET_NAME = os.getenv('BUCKET_NAME')
+CUSTOM_DOMAIN = os.getenv('CUSTOM_DOMAIN', 'https://your-domain.com')
+
+# 连接池与重试配置
+# HTTP_RETRIES 只覆盖连接错误和 500/502/504；429/503 由 transfer.open_image_stream 按 Retry-After
+# 暂停整个域名后重试（pipeline.THROTTLE_RETRIES 次）
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '32'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', '0.5'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '32'))
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', '5'))
+
+# 检查必要的环境变量
+if not all([ACCESS_KEY_ID, SECRET_ACCESS_KEY, ENDPOINT_URL, BUCKET_NAME]):
+    raise ValueError("请在 .env 文件中配置所有必要的环境变量: ACCESS_KEY_ID, SECRET_ACCESS_KEY, ENDPOINT_URL, BUCKET_NAME")
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    为没有显式指定 timeout 的请求设置默认超时
+    显式指定单个秒数时（按请求截止时间剩余的秒数）作为上限，与默认的连接/读取超时取较小值
+    """
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            kwargs['timeout'] = self.timeout
+        elif isinstance(timeout, (int, float)) and isinstance(self.timeout, tuple):
+            kwargs['timeout'] = tuple(min(limit, timeout) for limit in self.timeout)
+        return super().send(request, **kwargs)
+
+
+def create_http_session():
+    """
+    创建带连接池、自动重试和默认超时的 requests.Session
+    同一域名的多张图片复用 keep-alive 连接，不必每次重新握手
+    """
+    # 429/503 不在这里重试：由 transfer.open_image_stream 配合域名调度器按 Retry-After 暂停整个域名
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 504),
+        allowed_methods=('GET', 'HEAD'),
+        raise_on_status=False
+    )
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry,
+        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    )
+    http_session = requests.Session()
+    http_session.mount('http://', adapter)
+    http_session.mount('https://', adapter)
+    return http_session
+
+
+def create_s3_client():
+    """
+    创建 S3 兼容客户端，连接池大小与重试策略可配置
+    """
+    session = boto3.session.Session()
+    return session.client(
+        's3',
+        region_name='auto',
+        endpoint_url=ENDPOINT_URL,
+        aws_access_key_id=ACCESS_KEY_ID,
+        aws_secret_access_key=SECRET_ACCESS_KEY,
+        config=Config(
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'standard'}
+        )
+    )
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _per_process(name, factory):
+    """
+    第一次使用时创建，之后在本进程内共享（boto3 客户端和 requests.Session 均可跨线程使用）
+    按进程号区分，多进程部署时每个 worker 各自创建，不会沿用 fork 前父进程的连接
+    """
+    pid = os.getpid()
+    with _clients_lock:
+        entry = _clients.get(name)
+        if entry is None or entry[0] != pid:
+            entry = (pid, factory())
+            _clients[name] = entry
+        return entry[1]
+
+
+def get_http_session():
+    return _per_process('http', create_http_session)
+
+
+def get_s3_client():
+    return _per_process('s3', create_s3_client)
+
+
+def public_url(key):
+    return f"{CUSTOM_DOMAIN}/{key}"
+
+
+def hosted_prefixes():
+    """
+    本存储桶对外的URL前缀，以这些前缀开头的图片已经转存过，无需再次处理
+    """
+    return (f"{CUSTOM_DOMAIN}/", f"{ENDPOINT_URL.rstrip('/')}/{BUCKET_NAME}/")
+
+
+def observed(image_url, stats, func):
+    """
+    执行单张图片的转存并记录指标（结果分类、总耗时、各阶段耗时、字节数）
+    """
+    stats = stats if stats is not None else {}
+    source = describe_url(image_url)
+    started = time.monotonic()
+    try:
+        result = func(stats)
+    except Exception as e:
+        observe_image(source, stats, time.monotonic() - started, e)
+        raise
+    observe_image(source, stats, time.monotonic() - started)
+    return result
+
+
+def upload_image(image_url, default_extension='', key_mode=None, stats=None, optimize=None, width=None,
+                 deadline=None):
+    """
+    将图片URL转存到R2并返回公开URL，失败时抛出异常
+    Web 应用和命令行共用这一个实现
+    optimize 为优化格式（未指定时取环境变量 OPTIMIZE_FORMAT），width 为缩放的目标宽度
+    deadline 为请求的截止时间（deadline.Deadline），到期时抛出 DeadlineExceeded
+    """
+    optimize = resolve_optimize(optimize)
+    key = observed(
+        image_url, stats,
+        lambda stats: mirror_url(
+            get_s3_client(), BUCKET_NAME, image_url, default_extension, key_mode, stats,
+            session=get_http_session(), optimize=optimize, width=width, deadline=deadline
+        )
+    )
+    return public_url(key)
+
+
+def upload_responsive_image(image_url, width=None, key_mode=None, stats=None, optimize=None, deadline=None):
+    """
+    生成多个尺寸的版本并上传，返回 {'src': ..., 'srcset': ..., 'sizes': ...}
+    图片无法解码时退化为普通上传，直接返回公开URL
+    未指定 optimize 时保持原格式
+    """
+    optimize = resolve_optimize(optimize) or 'keep'
+    variants = observed(
+        image_url, stats,
+        lambda stats: mirror_variants(
+            get_s3_client(), BUCKET_NAME, image_url, responsive_targets(width), optimize, key_mode, stats,
+            session=get_http_session(), deadline=deadline
+        )
+    )
+    if len(variants) == 1:
+        return public_url(variants[0]['key'])
+
+    width_descriptors = variants[0]['descriptor'].endswith('w')
+    # 宽度断点模式下 src 使用最大的版本，密度模式下使用 1x 版本
+    fallback = variants[-1] if width_descriptors else variants[0]
+    return {
+        'src': public_url(fallback['key']),
+        'srcset': ', '.join(f"{public_url(v['key'])} {v['descriptor']}" for v in variants),
+        'sizes': SRCSET_SIZES if width_descriptors else None
+    }
@@ -0,0 +1,59 @@
+import os
+import time
+
+# 同步接口（/process、/process_stream、/console_process）处理一次请求的总时间（秒），0 表示不限制
+# 应小于 WEB_TIMEOUT，到期时返回已完成的部分结果，而不是被 Gunicorn 强制中断
+REQUEST_DEADLINE = float(os.getenv('REQUEST_DEADLINE', '120'))
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    请求的截止时间已到
+    """
+
+
+class Deadline:
+    """
+    一次请求中所有图片共用的截止时间
+
+    seconds 为 None 或 0 时不限制。各个环节（域名暂停、内存预算、HTTP 连接与读取、读取响应体）
+    按剩余时间收紧自己的超时，到期后尚未完成的传输在下一次读取时中止。
+    """
+    def __init__(self, seconds=None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        """
+        剩余秒数，不限制时返回 None
+        """
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("已超过截止时间")
+
+    def timeout(self, default=None):
+        """
+        不超过剩余时间的等待秒数：default 为 None 时直接返回剩余时间，已到期时抛出 DeadlineExceeded
+        """
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return remaining if default is None else min(default, remaining)
+
+
+def request_deadline(seconds=None):
+    """
+    按请求参数创建截止时间：请求可以指定更短的时间，但不能超过 REQUEST_DEADLINE
+    """
+    limit = REQUEST_DEADLINE or None
+    if seconds:
+        seconds = float(seconds)
+        limit = min(seconds, limit) if limit else seconds
+    return Deadline(limit)
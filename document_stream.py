@@ -0,0 +1,103 @@
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import MAX_WORKERS, get_host_scheduler
+from planner import skip_reason
+from markdown_images import iter_markdown_segments, build_image_tag
+from data_uri import describe_url
+
+# 超大文档的流式处理：每次读取的字符数
+DOCUMENT_CHUNK_SIZE = int(os.getenv('DOCUMENT_CHUNK_SIZE', str(1024 * 1024)))
+# 按顺序输出时最多等待的图片数，以及等待期间缓存的文本字符数，超出时阻塞读取
+DOCUMENT_WINDOW = int(os.getenv('DOCUMENT_WINDOW', '256'))
+DOCUMENT_WINDOW_BYTES = int(os.getenv('DOCUMENT_WINDOW_BYTES', str(16 * 1024 * 1024)))
+# 记住最近多少个URL的结果，文档中重复出现的图片只传输一次
+DOCUMENT_DEDUPE_ENTRIES = int(os.getenv('DOCUMENT_DEDUPE_ENTRIES', '10000'))
+
+# 结果中最多列出的失败图片数
+MAX_REPORTED_FAILURES = 100
+
+
+def rewrite_markdown_stream(reader, upload, summary=None, hosted_prefixes=(), per_width=False,
+                            chunk_size=DOCUMENT_CHUNK_SIZE, limiter=None):
+    """
+    流式改写markdown：分块读取 reader，依次产生改写后的文本片段
+
+    upload(url, width) 上传单个图片并返回新链接，失败返回 None。
+    图片在后台并发上传（按域名限流），输出严格保持原文顺序：等待中的图片超过 DOCUMENT_WINDOW 个
+    或缓存的文本超过 DOCUMENT_WINDOW_BYTES 时暂停读取，内存占用与文档大小无关。
+    传入 summary 字典时写入统计：total / processed / skipped / failed / failed_images
+    """
+    summary = summary if summary is not None else {}
+    summary.update({'total': 0, 'processed': 0, 'skipped': 0, 'failed': 0, 'failed_images': []})
+    limiter = limiter or get_host_scheduler()
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    # (url, width) -> Future，超出上限时淘汰最早的条目
+    transfers = OrderedDict()
+    # 按原文顺序等待输出的 (文本, 图片信息, Future)
+    pending = deque()
+    pending_chars = 0
+
+    def transfer(img_info):
+        key = (img_info['url'], img_info.get('width') if per_width else None)
+        future = transfers.get(key)
+        if future is None:
+            future = executor.submit(limiter.run, img_info['url'], upload, img_info['url'], img_info.get('width'))
+            transfers[key] = future
+            if len(transfers) > DOCUMENT_DEDUPE_ENTRIES:
+                transfers.popitem(last=False)
+        else:
+            transfers.move_to_end(key)
+        return future
+
+    def settle(text, img_info, future):
+        if img_info is None:
+            return text
+        if img_info.get('error'):
+            # 无法完整读取的图片（如超过上限的内嵌图片），原文保持不变
+            print(f"❌ 上传图片失败: {img_info['error']}")
+            new_url = None
+        elif future is None:
+            return text + img_info['full_match']
+        else:
+            try:
+                new_url = future.result()
+            except Exception as e:
+                print(f"❌ 上传图片失败: {e}")
+                new_url = None
+        if new_url:
+            summary['processed'] += 1
+            return text + build_image_tag(img_info, new_url)
+        summary['failed'] += 1
+        if len(summary['failed_images']) < MAX_REPORTED_FAILURES:
+            summary['failed_images'].append(describe_url(img_info['url']))
+        return text + img_info['full_match']
+
+    try:
+        for text, img_info in iter_markdown_segments(reader, chunk_size):
+            future = None
+            if img_info is not None:
+                summary['total'] += 1
+                # 带有 error 的图片无法上传，由 settle 计为失败
+                if not img_info.get('error'):
+                    if skip_reason(img_info['url'], hosted_prefixes):
+                        summary['skipped'] += 1
+                    else:
+                        future = transfer(img_info)
+            if not pending and future is None:
+                yield settle(text, img_info, None)
+                continue
+
+            pending.append((text, img_info, future))
+            pending_chars += len(text)
+            # 最早的图片完成后立即输出；等待的图片或缓存的文本过多时阻塞等待
+            while pending and (pending[0][2] is None or pending[0][2].done()
+                               or len(pending) > DOCUMENT_WINDOW or pending_chars > DOCUMENT_WINDOW_BYTES):
+                entry = pending.popleft()
+                pending_chars -= len(entry[0])
+                yield settle(*entry)
+
+        while pending:
+            yield settle(*pending.popleft())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 后台任务配置
+# JOB_STORE_PATH 为任务持久化文件，JOB_WORKERS 为同时处理的文章数
+JOB_STORE_PATH = os.getenv('JOB_STORE_PATH', 'jobs.sqlite3')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# 已结束的任务保留时间（秒），启动时清理过期任务
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', str(7 * 24 * 3600)))
+# 运行中的任务检查取消请求的最短间隔（秒），取消请求可能由其他 worker 进程写入任务文件
+CANCEL_POLL_INTERVAL = float(os.getenv('CANCEL_POLL_INTERVAL', '1'))
+
+# 任务状态
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobStore:
+    """
+    基于 SQLite 的任务存储，进程重启后任务仍然存在
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    finished INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            # 旧版本创建的任务文件没有 worker、cancel_requested 列
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')}
+            if 'worker' not in columns:
+                self._conn.execute('ALTER TABLE jobs ADD COLUMN worker TEXT')
+            if 'cancel_requested' not in columns:
+                self._conn.execute('ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0')
+
+    def create(self, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO jobs (id, status, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, QUEUED, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def update(self, job_id, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'], ensure_ascii=False)
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def transition(self, job_id, from_statuses, to_status):
+        """
+        仅当任务处于 from_statuses 之一时才修改状态，返回是否修改成功
+        """
+        placeholders = ', '.join('?' for _ in from_statuses)
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f'UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status IN ({placeholders})',
+                (to_status, time.time(), job_id, *from_statuses)
+            )
+        return cursor.rowcount == 1
+
+    def request_cancel(self, job_id):
+        """
+        为运行中的任务记录取消请求，由处理它的进程轮询后停止，返回是否记录成功
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ? AND status = ?',
+                (time.time(), job_id, RUNNING)
+            )
+        return cursor.rowcount == 1
+
+    def cancel_requested(self, job_id):
+        with self._lock:
+            row = self._conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def claim(self, job_id, worker):
+        """
+        将排队中的任务标记为运行中并记录处理它的进程，多个进程共享任务文件时只有一个能成功
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'UPDATE jobs SET status = ?, worker = ?, updated_at = ? WHERE id = ? AND status = ?',
+                (RUNNING, worker, time.time(), job_id, QUEUED)
+            )
+        return cursor.rowcount == 1
+
+    def requeue(self, job_id, worker):
+        """
+        将已退出的进程遗留的运行中任务重新排队，任务已被其他进程处理时不做修改
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'UPDATE jobs SET status = ?, finished = 0, updated_at = ? WHERE id = ? AND status = ? AND worker IS ?',
+                (QUEUED, time.time(), job_id, RUNNING, worker)
+            )
+        return cursor.rowcount == 1
+
+    def unfinished(self):
+        """
+        返回所有未结束的任务（id、status、worker、cancel_requested），按创建时间排序
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, status, worker, cancel_requested FROM jobs WHERE status IN (?, ?) ORDER BY created_at', (QUEUED, RUNNING)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def purge(self, older_than):
+        placeholders = ', '.join('?' for _ in FINISHED_STATUSES)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f'DELETE FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?',
+                (*FINISHED_STATUSES, older_than)
+            )
+
+
+def current_worker():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def worker_alive(worker):
+    """
+    判断记录的进程是否仍在运行；其他主机上的进程无法判断，视为仍在运行
+    """
+    if not worker:
+        return False
+    hostname, _, pid = worker.rpartition(':')
+    if hostname != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobManager:
+    """
+    后台任务队列：接收任务后立即返回任务ID，由线程池在后台处理
+
+    handler(payload, on_event, cancel_event) 负责实际处理并返回结果字典，
+    on_event 接收与 process_markdown_article 相同的进度事件。
+    启动时会重新排队上次未完成的任务；多个 worker 进程共享任务文件时，
+    其他仍在运行的进程正在处理的任务不会被抢走，排队中的任务只会被一个进程领取。
+    取消请求写入任务文件，处理任务的进程在进度事件中轮询，因此可以通过任意进程取消任务。
+    """
+    def __init__(self, store, handler, workers=JOB_WORKERS):
+        self.store = store
+        self.handler = handler
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='job')
+        self._cancel_events = {}
+        self._lock = threading.Lock()
+
+        self.store.purge(time.time() - JOB_RETENTION)
+        for job in self.store.unfinished():
+            if job['status'] == RUNNING:
+                if worker_alive(job['worker']):
+                    continue
+                # 已请求取消的任务不再恢复
+                if job['cancel_requested']:
+                    self.store.transition(job['id'], (RUNNING,), CANCELLED)
+                    continue
+                if not self.store.requeue(job['id'], job['worker']):
+                    continue
+                print(f"🔁 恢复未完成的任务: {job['id']}")
+            self._schedule(job['id'])
+
+    def submit(self, payload):
+        job_id = self.store.create(payload)
+        self._schedule(job_id)
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        取消任务：排队中的任务直接取消，运行中的任务停止处理尚未开始的图片
+        运行中的任务可能在其他进程中，取消请求记录在任务文件中，由处理它的进程轮询
+        返回是否取消成功（已结束的任务无法取消）
+        """
+        if self.store.transition(job_id, (QUEUED,), CANCELLED):
+            return True
+        if not self.store.request_cancel(job_id):
+            return False
+        # 任务在本进程中运行时立即生效，不必等待下一次轮询
+        with self._lock:
+            cancel_event = self._cancel_events.get(job_id)
+        if cancel_event is not None:
+            cancel_event.set()
+        return True
+
+    def _schedule(self, job_id):
+        cancel_event = threading.Event()
+        with self._lock:
+            self._cancel_events[job_id] = cancel_event
+        self._executor.submit(self._run, job_id, cancel_event)
+
+    def _run(self, job_id, cancel_event):
+        try:
+            # 排队期间可能已被取消
+            if not self.store.claim(job_id, current_worker()):
+                return
+            job = self.store.get(job_id)
+            progress = {'total': 0, 'finished': 0, 'polled_at': time.monotonic()}
+            progress_lock = threading.Lock()
+
+            def on_event(event):
+                with progress_lock:
+                    now = time.monotonic()
+                    if not cancel_event.is_set() and now - progress['polled_at'] >= CANCEL_POLL_INTERVAL:
+                        progress['polled_at'] = now
+                        if self.store.cancel_requested(job_id):
+                            cancel_event.set()
+                    if event['event'] == 'start':
+                        progress['total'] = event['total']
+                        self.store.update(job_id, total=event['total'])
+                    elif event['event'] in ('uploaded', 'failed', 'skipped'):
+                        progress['finished'] += 1
+                        self.store.update(job_id, finished=progress['finished'])
+
+            try:
+                result = self.handler(job['payload'], on_event, cancel_event)
+            except Exception as e:
+                self.store.update(job_id, status=FAILED, result={'success': False, 'message': f'处理出错: {str(e)}'})
+                return
+
+            if cancel_event.is_set() or self.store.cancel_requested(job_id):
+                self.store.update(job_id, status=CANCELLED, result=result)
+            else:
+                self.store.update(job_id, status=SUCCEEDED if result.get('success') else FAILED, result=result)
+        finally:
+            with self._lock:
+                self._cancel_events.pop(job_id, None)
+
+
+def job_to_dict(job):
+    """
+    转换为接口返回的格式，不包含原始的 markdown 内容
+    """
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'total': job['total'],
+        'finished': job['finished'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+        'result': job['result']
+    }
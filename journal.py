@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from data_uri import source_id
+
+# 文章处理进度日志：记录每个图片的处理结果，重新处理同一篇文章时只重做失败或未完成的图片
+# JOURNAL_PATH 设为空字符串可关闭
+JOURNAL_PATH = os.getenv('JOURNAL_PATH', 'journal.sqlite3')
+# 未完成文章的记录保留时间（秒），启动时清理过期记录
+JOURNAL_RETENTION = int(os.getenv('JOURNAL_RETENTION', str(7 * 24 * 3600)))
+
+
+def document_key(text, **options):
+    """
+    文章的标识：内容与处理选项（命名方式、优化格式等）的 SHA-256
+    选项不同时得到的链接不同，不能互相复用
+    """
+    digest = hashlib.sha256(text.encode('utf-8'))
+    digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class Journal:
+    """
+    基于 SQLite 的处理进度日志，按 (文章标识, 图片位置) 记录已成功的结果
+
+    每个图片成功后立即写入，进程崩溃或部分失败后重新处理同一篇文章时，
+    位置和URL都一致的图片直接沿用之前的结果。文章全部成功后删除其记录。
+    """
+    def __init__(self, path, retention=JOURNAL_RETENTION):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS journal (
+                    document TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    source_url TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (document, position)
+                )
+            ''')
+            self._conn.execute('DELETE FROM journal WHERE updated_at < ?', (time.time() - retention,))
+
+    def results(self, document, urls):
+        """
+        返回与 urls 一一对应的已完成结果，未完成或URL已变化的位置为 None
+        data URI 以内容摘要比较和保存，不把 base64 写入日志
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT position, source_url, result FROM journal WHERE document = ?', (document,)
+            ).fetchall()
+        done = {position: (source_url, result) for position, source_url, result in rows}
+        results = []
+        for position, url in enumerate(urls):
+            entry = done.get(position)
+            results.append(json.loads(entry[1]) if entry and entry[0] == source_id(url) else None)
+        return results
+
+    def record(self, document, position, url, result):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO journal (document, position, source_url, result, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (document, position, source_id(url), json.dumps(result, ensure_ascii=False), time.time())
+            )
+
+    def forget(self, document):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM journal WHERE document = ?', (document,))
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """
+    返回全局进度日志实例，未配置 JOURNAL_PATH 时返回 None
+    """
+    global _journal
+    if not JOURNAL_PATH:
+        return None
+    with _journal_lock:
+        if _journal is None:
+            _journal = Journal(JOURNAL_PATH)
+        return _journal
@@ -0,0 +1,77 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# 单个对象的最大字节数，0 表示不限制
+MAX_OBJECT_SIZE = int(os.getenv('MAX_OBJECT_SIZE', str(100 * 1024 * 1024)))
+# 所有进行中的传输可占用的内存总量，0 表示不限制；超出时新的传输排队等待
+INFLIGHT_BYTES_BUDGET = int(os.getenv('INFLIGHT_BYTES_BUDGET', str(256 * 1024 * 1024)))
+# 等待内存预算的最长时间（秒）
+BUDGET_WAIT_TIMEOUT = float(os.getenv('BUDGET_WAIT_TIMEOUT', '300'))
+
+
+class ObjectTooLarge(Exception):
+    """
+    对象超过 MAX_OBJECT_SIZE
+    不继承 ValueError：werkzeug 解析表单时会静默忽略 ValueError，上传接口将无法报告原因
+    """
+
+
+class ByteBudget:
+    """
+    进程内的内存预算
+
+    每次传输开始前按预计占用的内存申请额度，传输结束后归还；
+    额度不足时阻塞等待，从而限制并发传输的总内存占用。
+    单次申请超过总额度时按总额度计算，保证大对象最终可以独占预算执行。
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes, timeout=BUDGET_WAIT_TIMEOUT):
+        """
+        申请额度，返回实际占用的字节数（归还时传回），超时抛出 TimeoutError
+        """
+        if not self.capacity:
+            return 0
+        nbytes = min(max(0, nbytes), self.capacity)
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_use + nbytes <= self.capacity, timeout):
+                raise TimeoutError(f"等待内存预算超时（需要 {nbytes} 字节，已占用 {self.in_use} 字节）")
+            self.in_use += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        if not nbytes:
+            return
+        with self._condition:
+            self.in_use -= nbytes
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        granted = self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(granted)
+
+
+_budget = ByteBudget(INFLIGHT_BYTES_BUDGET)
+
+
+def get_byte_budget():
+    """
+    返回进程内共享的内存预算
+    """
+    return _budget
+
+
+def check_size(size, max_size=MAX_OBJECT_SIZE):
+    """
+    size 超过 max_size 时抛出 ObjectTooLarge，size 为 None（未知）时不检查
+    """
+    if max_size and size is not None and size > max_size:
+        raise ObjectTooLarge(f"文件大小 {size} 字节超过上限 {max_size} 字节")
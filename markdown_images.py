@@ -0,0 +1,219 @@
+import re
+import html
+from html.parser import HTMLParser
+from limits import MAX_OBJECT_SIZE
+
+class ImageHTMLParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.img_src = None
+        self.img_width = None
+    
+    def handle_starttag(self, tag, attrs):
+        if tag == 'img':
+            for attr, value in attrs:
+                if attr == 'src':
+                    self.img_src = value
+                elif attr == 'width':
+                    self.img_width = value
+
+    def parse(self, img_tag):
+        """
+        复用同一个解析器解析img标签，返回 (src, width)
+        """
+        self.reset()
+        self.img_src = None
+        self.img_width = None
+        self.feed(img_tag)
+        return self.img_src, self.img_width
+
+# 单独的<img>标签
+IMG_TAG_PATTERN = re.compile(r'<img\s+[^>]*>', re.IGNORECASE)
+
+# 一次扫描同时识别三种图片写法，同一位置优先匹配包含在<a>标签中的<img>
+IMAGE_TOKEN_PATTERN = re.compile(
+    r'(?P<a_img><a\s+[^>]*>\s*(?P<a_img_tag><img\s+[^>]*>)\s*</a>)'
+    r'|(?P<html><img\s+[^>]*>)'
+    r'|(?P<markdown>!\[(?P<alt>[^\]]*)\]\((?P<url>[^)]+)\))',
+    re.IGNORECASE
+)
+
+# 流式处理时单个图片写法的最大长度（字符），跨越读取边界但不超过该长度的图片都能识别
+MAX_TOKEN_LENGTH = 64 * 1024
+
+# 内嵌图片（data URI）写法的开头，用于识别跨越读取边界、尚未闭合的内嵌图片
+DATA_TOKEN_START_PATTERN = re.compile(
+    r'!\[[^\]]*\]\(\s*data:|<img\s+[^>]*?src\s*=\s*["\']?\s*data:', re.IGNORECASE
+)
+# 流式处理时单个内嵌图片写法的最大长度（字符）：MAX_OBJECT_SIZE 的 base64 长度加上标签本身，0 表示不限制
+MAX_DATA_TOKEN_LENGTH = MAX_OBJECT_SIZE * 4 // 3 + MAX_TOKEN_LENGTH if MAX_OBJECT_SIZE else 0
+
+def image_info_from_match(match, parser):
+    """
+    将 IMAGE_TOKEN_PATTERN 的匹配结果转换为图片信息，没有 src 的img标签返回 None
+    """
+    if match.group('markdown') is not None:
+        return {
+            'type': 'markdown',
+            'full_match': match.group(0),
+            'alt': match.group('alt'),
+            'url': match.group('url'),
+            'start': match.start(),
+            'end': match.end()
+        }
+
+    if match.group('a_img') is not None:
+        # 包含在a标签中的img，替换时去掉整个a标签
+        img_tag = match.group('a_img_tag')
+        img_src, img_width = parser.parse(img_tag)
+        if img_src:
+            return {
+                'type': 'a_img',
+                'full_match': match.group(0),
+                'img_tag': img_tag,
+                'url': img_src,
+                'width': img_width,
+                'start': match.start(),
+                'end': match.end()
+            }
+    else:
+        img_src, img_width = parser.parse(match.group(0))
+        if img_src:
+            return {
+                'type': 'html',
+                'full_match': match.group(0),
+                'url': img_src,
+                'width': img_width,
+                'start': match.start(),
+                'end': match.end()
+            }
+    return None
+
+def extract_images_from_markdown(text):
+    """
+    从markdown文本中提取所有图片信息
+    支持markdown语法 ![alt](url) 和 HTML img标签，以及包含在<a>标签中的img标签
+    只扫描一遍文本，结果按出现位置从前往后排列
+    """
+    images = []
+    parser = ImageHTMLParser()
+
+    for match in IMAGE_TOKEN_PATTERN.finditer(text):
+        img_info = image_info_from_match(match, parser)
+        if img_info:
+            images.append(img_info)
+
+    return images
+
+def open_data_token(buffer, start, end):
+    """
+    在 buffer[start:end] 中查找尚未闭合的内嵌图片（data URI）写法，返回 (开始位置, 闭合字符)，没有时返回 None
+    """
+    for match in DATA_TOKEN_START_PATTERN.finditer(buffer, start, end):
+        close = ')' if match.group(0).startswith('!') else '>'
+        if buffer.find(close, match.end()) < 0:
+            return match.start(), close
+    return None
+
+def iter_markdown_segments(reader, chunk_size=1024 * 1024):
+    """
+    分块读取markdown（reader 为文本文件对象），依次产生 (文本, 图片信息)，
+    文本为上一个图片与本图片之间的内容；不含图片的文本以 (文本, None) 产生。
+    把所有片段依次拼接即为原文，内存占用约为 chunk_size + MAX_TOKEN_LENGTH，与文档大小无关。
+    图片信息中的 start / end 为在当前缓冲区中的位置，不是在整个文档中的位置。
+
+    内嵌图片（data URI）可能远超 MAX_TOKEN_LENGTH：跨越读取边界时继续读取直到写法闭合，
+    最多 MAX_DATA_TOKEN_LENGTH 个字符；超出时整段按原文输出，图片信息带有 error，由调用方计为失败。
+    """
+    parser = ImageHTMLParser()
+    buffer = ''
+    eof = False
+    # 尚未闭合的内嵌图片：(开始位置, 闭合字符, 已查找到的位置)
+    open_token = None
+    while not eof:
+        chunk = reader.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+        if open_token is not None and not eof:
+            token_start, close, searched = open_token
+            if buffer.find(close, searched) < 0:
+                if not MAX_DATA_TOKEN_LENGTH or len(buffer) - token_start <= MAX_DATA_TOKEN_LENGTH:
+                    open_token = (token_start, close, len(buffer))
+                    continue
+                # 超过上限，不再等待闭合
+                head = buffer[token_start:token_start + MAX_TOKEN_LENGTH]
+                yield buffer[:token_start], None
+                yield buffer[token_start:], {
+                    'type': 'oversized',
+                    'full_match': '',
+                    'url': head[head.lower().index('data:'):],
+                    'error': f'内嵌图片超过 {MAX_DATA_TOKEN_LENGTH} 个字符'
+                }
+                buffer = ''
+            open_token = None
+        # 缓冲区末尾 MAX_TOKEN_LENGTH 内开始的图片可能还不完整，留到下一轮与后续内容一起识别
+        cut = len(buffer) if eof else max(0, len(buffer) - MAX_TOKEN_LENGTH)
+        if not eof:
+            unclosed = open_data_token(buffer, 0, cut)
+            if unclosed is not None:
+                # 之前的内容照常处理，内嵌图片留在缓冲区中等待闭合
+                open_token = (unclosed[0], unclosed[1], len(buffer))
+                cut = unclosed[0]
+        position = 0
+        keep_from = cut
+        for match in IMAGE_TOKEN_PATTERN.finditer(buffer):
+            if match.start() >= cut:
+                break
+            keep_from = max(keep_from, match.end())
+            img_info = image_info_from_match(match, parser)
+            if img_info:
+                yield buffer[position:match.start()], img_info
+                position = match.end()
+        if keep_from > position:
+            yield buffer[position:keep_from], None
+        removed = max(position, keep_from)
+        buffer = buffer[removed:]
+        if open_token is not None:
+            open_token = (open_token[0] - removed, open_token[1], open_token[2] - removed)
+
+def build_image_tag(img_info, new_url):
+    """
+    根据原图片的写法生成替换后的标签
+    new_url 为字典 {'src', 'srcset', 'sizes'} 时生成响应式的img标签
+    """
+    if isinstance(new_url, dict):
+        return build_responsive_tag(img_info, new_url)
+    if img_info['type'] == 'markdown':
+        return f"![{img_info['alt']}]({new_url})"
+    # html img 标签以及包含在a标签中的img，都输出为单独的img标签
+    width_attr = f' width="{img_info["width"]}"' if img_info.get('width') else ''
+    return f'<img src="{new_url}"{width_attr} />'
+
+def build_responsive_tag(img_info, image):
+    """
+    生成带 srcset / sizes 的img标签，markdown 图片的 alt 文本会保留
+    """
+    attrs = [f'src="{image["src"]}"', f'srcset="{image["srcset"]}"']
+    if image.get('sizes'):
+        attrs.append(f'sizes="{image["sizes"]}"')
+    if img_info.get('width'):
+        attrs.append(f'width="{img_info["width"]}"')
+    if img_info.get('alt'):
+        attrs.append(f'alt="{html.escape(img_info["alt"], quote=True)}"')
+    return f'<img {" ".join(attrs)} />'
+
+def rewrite_markdown(text, images, new_urls):
+    """
+    将上传成功的图片替换为新链接，images 需按位置从前往后排列
+    只拼接一次字符串，耗时与文本长度成线性关系
+    """
+    parts = []
+    position = 0
+    for img_info, new_url in zip(images, new_urls):
+        if not new_url:
+            continue
+        parts.append(text[position:img_info['start']])
+        parts.append(build_image_tag(img_info, new_url))
+        position = img_info['end']
+    parts.append(text[position:])
+    return ''.join(parts)
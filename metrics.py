@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from limits import ObjectTooLarge
+from deadline import DeadlineExceeded
+
+# 每张图片处理完成后输出一行 JSON 日志（包含各阶段耗时），便于日志系统采集
+METRICS_LOG_JSON = os.getenv('METRICS_LOG_JSON', '').lower() in ('1', 'true', 'yes')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Prometheus 计数器，按标签分别累计
+    """
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus 直方图，按标签分别统计各区间的观测次数、总和与总数
+    """
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+IMAGES_TOTAL = Counter(
+    'r2uploader_images_total', '处理的图片数，按结果分类', ('outcome',)
+)
+IMAGE_SECONDS = Histogram(
+    'r2uploader_image_seconds', '单张图片的总耗时（秒）', ('outcome',)
+)
+STAGE_SECONDS = Histogram(
+    'r2uploader_stage_seconds', '单张图片各阶段的耗时（秒）', ('stage',)
+)
+BYTES_TOTAL = Counter(
+    'r2uploader_bytes_total', '传输的字节数，source 为从源站或客户端读取，stored 为写入R2', ('kind',)
+)
+HEDGED_REQUESTS_TOTAL = Counter(
+    'r2uploader_hedged_requests_total', '源站响应慢时发出的对冲请求数，winner 为先返回的一方', ('winner',)
+)
+
+REGISTRY = [IMAGES_TOTAL, IMAGE_SECONDS, STAGE_SECONDS, BYTES_TOTAL, HEDGED_REQUESTS_TOTAL]
+
+
+def render_metrics():
+    """
+    以 Prometheus 文本格式输出所有指标
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def add_timing(stats, stage_name, seconds):
+    """
+    将耗时累计到 stats['timings'][stage_name]，stats 为 None 时不记录
+    """
+    if stats is None:
+        return
+    timings = stats.setdefault('timings', {})
+    timings[stage_name] = timings.get(stage_name, 0.0) + seconds
+
+
+@contextmanager
+def stage(stats, stage_name):
+    """
+    记录一个阶段的耗时，阶段有：connect 连接并收到响应头（含 DNS、TCP/TLS 握手和源站首字节）、
+    download 读取源站响应体、hash 计算内容摘要、process 图片优化、upload 写入R2
+    期间累计到其他阶段的时间会被扣除，例如流式上传时等待源站数据的时间只计入 download
+    """
+    if stats is None:
+        yield
+        return
+    timings = stats.setdefault('timings', {})
+    nested_before = sum(timings.values())
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        nested = sum(timings.values()) - nested_before
+        add_timing(stats, stage_name, max(0.0, time.monotonic() - started - nested))
+
+
+def classify_error(error):
+    """
+    将异常归类为 too_large（超过大小上限）、deadline_exceeded（超过请求的截止时间）、
+    origin_error（源站）、storage_error（R2）或 error
+    """
+    if isinstance(error, ObjectTooLarge):
+        return 'too_large'
+    if isinstance(error, DeadlineExceeded):
+        return 'deadline_exceeded'
+    module = type(error).__module__ or ''
+    if module.startswith(('requests', 'urllib3')):
+        return 'origin_error'
+    if module.startswith(('botocore', 'boto3', 's3transfer')):
+        return 'storage_error'
+    return 'error'
+
+
+def observe_image(source, stats, seconds, error=None):
+    """
+    记录一张图片的处理结果：更新指标，并按需输出 JSON 日志
+    stats 为传输过程中填写的统计字典（bytes、optimized_bytes、cached、timings）
+    """
+    stats = stats or {}
+    if error is not None:
+        outcome = classify_error(error)
+    elif stats.get('cached'):
+        outcome = 'cached'
+    else:
+        outcome = 'uploaded'
+
+    IMAGES_TOTAL.inc(outcome=outcome)
+    IMAGE_SECONDS.observe(seconds, outcome=outcome)
+    timings = stats.get('timings', {})
+    for stage_name, stage_seconds in timings.items():
+        STAGE_SECONDS.observe(stage_seconds, stage=stage_name)
+    source_bytes = stats.get('bytes', 0)
+    stored_bytes = 0 if outcome != 'uploaded' else stats.get('optimized_bytes', source_bytes)
+    BYTES_TOTAL.inc(source_bytes, kind='source')
+    BYTES_TOTAL.inc(stored_bytes, kind='stored')
+
+    if METRICS_LOG_JSON:
+        record = {
+            'ts': round(time.time(), 3),
+            'source': source,
+            'outcome': outcome,
+            'ms': round(seconds * 1000),
+            'bytes': source_bytes,
+            'stored_bytes': stored_bytes,
+            'stages_ms': {name: round(value * 1000) for name, value in timings.items()}
+        }
+        if error is not None:
+            record['error'] = str(error)
+        print(json.dumps(record, ensure_ascii=False), flush=True)
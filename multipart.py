@@ -0,0 +1,161 @@
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from limits import check_size
+
+# 分片上传配置：分片大小（R2/S3 要求除最后一片外不小于 5MB）、同时上传的分片数、单个分片的重试次数
+MULTIPART_PART_SIZE = max(int(os.getenv('MULTIPART_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+MULTIPART_CONCURRENCY = int(os.getenv('MULTIPART_CONCURRENCY', '4'))
+MULTIPART_PART_RETRIES = int(os.getenv('MULTIPART_PART_RETRIES', '3'))
+
+
+class MultipartUploadWriter:
+    """
+    可写入的文件对象，写入的数据按分片并发上传到R2
+
+    数据攒满一个分片后立即提交到线程池上传，同时在途的分片数有上限，
+    超过时 write 会阻塞，从而对上游（例如请求体）形成背压，内存占用固定。
+    不足一个分片的小文件在 complete 时用一次 put_object 上传。
+    写入过程中同时计算 SHA-256，供内容寻址命名使用。
+    传入 max_size 时，写入的数据超过上限会抛出 ObjectTooLarge；
+    传入 budget 时按最大缓冲量申请内存预算，上传结束或取消时归还。
+    """
+    def __init__(self, client, bucket, key, content_type,
+                 part_size=MULTIPART_PART_SIZE, concurrency=MULTIPART_CONCURRENCY,
+                 retries=MULTIPART_PART_RETRIES, max_size=None, budget=None, expected_size=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type or 'application/octet-stream'
+        self.part_size = part_size
+        self.retries = max(1, retries)
+        self.max_size = max_size
+        self.size = 0
+        self.completed = False
+        self._digest = hashlib.sha256()
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        # 在途分片（排队 + 上传中）的上限
+        self._slots = threading.BoundedSemaphore(max(1, concurrency) * 2)
+        # 最多缓存：在途分片 + 正在攒的一个分片
+        buffered = part_size * (max(1, concurrency) * 2 + 1)
+        if expected_size is not None:
+            buffered = min(buffered, expected_size)
+        self._budget = budget
+        self._reserved = budget.acquire(buffered) if budget else 0
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def write(self, data):
+        check_size(self.size + len(data), self.max_size)
+        self._digest.update(data)
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._submit(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        # 表单解析器写完后会调用 seek(0)，数据已经上传，无需处理
+        return 0
+
+    def _submit(self, data):
+        if self._upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ACL='public-read',
+                ContentType=self.content_type
+            )
+            self._upload_id = response['UploadId']
+
+        # 先检查已完成的分片是否出错，尽早失败
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+
+        self._slots.acquire()
+        part_number = len(self._futures) + 1
+        future = self._executor.submit(self._upload_part, part_number, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def _upload_part(self, part_number, data):
+        """
+        上传单个分片，失败时只重试该分片
+        """
+        for attempt in range(1, self.retries + 1):
+            try:
+                response = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    PartNumber=part_number,
+                    Body=data
+                )
+                return {'PartNumber': part_number, 'ETag': response['ETag']}
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print(f"⚠️ 分片 {part_number} 上传失败，第 {attempt} 次重试: {e}")
+                time.sleep(0.5 * 2 ** (attempt - 1))
+
+    def complete(self):
+        """
+        上传剩余数据并合并分片，出错时取消整个分片上传
+        """
+        try:
+            if self._upload_id is None:
+                self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=bytes(self._buffer),
+                    ACL='public-read',
+                    ContentType=self.content_type
+                )
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={'Parts': parts}
+                )
+            self.completed = True
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._executor.shutdown(wait=False)
+            self._release_budget()
+
+    def _release_budget(self):
+        if self._budget and self._reserved:
+            self._budget.release(self._reserved)
+            self._reserved = 0
+
+    def abort(self):
+        """
+        放弃上传，清理R2上已上传的分片
+        """
+        if self.completed:
+            return
+        self._buffer = bytearray()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._release_budget()
+        if self._upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            except Exception as e:
+                print(f"⚠️ 取消分片上传失败: {e}")
+            self._upload_id = None
@@ -0,0 +1,194 @@
+import io
+import os
+import re
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# 图片优化配置（需要安装 Pillow）
+# OPTIMIZE_FORMAT 为空表示不处理；webp / avif 转码；keep 保持原格式，只缩放并去除 EXIF
+OPTIMIZE_FORMATS = ('webp', 'avif', 'keep')
+OPTIMIZE_FORMAT = os.getenv('OPTIMIZE_FORMAT', '')
+OPTIMIZE_QUALITY = int(os.getenv('OPTIMIZE_QUALITY', '80'))
+OPTIMIZE_WORKERS = int(os.getenv('OPTIMIZE_WORKERS', str(os.cpu_count() or 2)))
+
+# 响应式图片：没有像素宽度的图片按这些断点生成多个版本，sizes 属性的默认值
+SRCSET_WIDTHS = [int(w) for w in os.getenv('SRCSET_WIDTHS', '480,960,1440').split(',') if w.strip()]
+SRCSET_SIZES = os.getenv('SRCSET_SIZES', '100vw')
+
+OUTPUT_TYPES = {
+    'WEBP': ('image/webp', '.webp'),
+    'AVIF': ('image/avif', '.avif'),
+    'JPEG': ('image/jpeg', '.jpg'),
+    'PNG': ('image/png', '.png'),
+    'GIF': ('image/gif', '.gif'),
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def optimize_requested(optimize=None):
+    """
+    是否要求优化（未指定时看环境变量 OPTIMIZE_FORMAT），只看设置，不校验格式也不检查 Pillow
+    """
+    return (optimize if optimize is not None else OPTIMIZE_FORMAT).lower() not in ('', 'none', 'off')
+
+
+def resolve_optimize(optimize=None):
+    """
+    校验优化格式，未指定时使用环境变量 OPTIMIZE_FORMAT，返回 None 表示不处理
+    """
+    if not optimize_requested(optimize):
+        return None
+    optimize = (optimize if optimize is not None else OPTIMIZE_FORMAT).lower()
+    if optimize not in OPTIMIZE_FORMATS:
+        raise ValueError(f"不支持的优化格式: {optimize}，可选值: {', '.join(OPTIMIZE_FORMATS)}")
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        raise ValueError("图片优化需要安装 Pillow: pip install Pillow")
+    return optimize
+
+
+def parse_width(width):
+    """
+    解析img标签的width属性，只接受像素值（如 300、300px），百分比等返回 None
+    """
+    if width is None:
+        return None
+    match = re.fullmatch(r'\s*(\d+)\s*(px)?\s*', str(width))
+    if not match or int(match.group(1)) == 0:
+        return None
+    return int(match.group(1))
+
+
+def _load_image(data):
+    """
+    解码图片并按 EXIF 方向旋转，返回 (图片, 原格式, ICC 配置)
+    动图或无法识别的格式返回 None
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        original_format = image.format
+        if getattr(image, 'is_animated', False):
+            return None
+        icc_profile = image.info.get('icc_profile')
+        # 先按 EXIF 方向旋转，之后保存时不再写入 EXIF
+        image = ImageOps.exif_transpose(image)
+    except Exception:
+        return None
+    return image, original_format, icc_profile
+
+
+def _encode_image(image, original_format, icc_profile, optimize, width, quality):
+    """
+    缩放到指定宽度（不放大）并编码，返回 (数据, Content-Type, 扩展名, 实际宽度)
+    """
+    from PIL import Image
+
+    if width and image.width > width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+
+    output_format = original_format if optimize == 'keep' else optimize.upper()
+    if output_format not in OUTPUT_TYPES:
+        return None
+    if output_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        image = image.convert('RGBA')
+
+    save_args = {'format': output_format}
+    if output_format in ('WEBP', 'AVIF', 'JPEG'):
+        save_args['quality'] = quality
+    if output_format == 'PNG':
+        save_args['optimize'] = True
+    if icc_profile:
+        save_args['icc_profile'] = icc_profile
+
+    buffer = io.BytesIO()
+    image.save(buffer, **save_args)
+    content_type, extension = OUTPUT_TYPES[output_format]
+    return buffer.getvalue(), content_type, extension, image.width
+
+
+def _optimize_image(data, optimize, width, quality):
+    """
+    在子进程中执行：缩放到指定宽度、去除 EXIF 并重新编码
+    无法处理的图片（动图、SVG 等）返回 None，调用方应上传原图
+    """
+    loaded = _load_image(data)
+    if loaded is None:
+        return None
+    encoded = _encode_image(*loaded, optimize, width, quality)
+    return encoded[:3] if encoded else None
+
+
+def _optimize_variants(data, optimize, widths, quality):
+    """
+    在子进程中执行：只解码一次，为每个目标宽度生成一个版本
+    返回 [(目标宽度, 实际宽度, 数据, Content-Type, 扩展名), ...]，无法处理时返回 None
+    """
+    loaded = _load_image(data)
+    if loaded is None:
+        return None
+    variants = []
+    for width in widths:
+        encoded = _encode_image(*loaded, optimize, width, quality)
+        if encoded is None:
+            return None
+        variant_data, content_type, extension, actual_width = encoded
+        variants.append((width, actual_width, variant_data, content_type, extension))
+    return variants
+
+
+def get_process_pool():
+    """
+    图片编解码占用CPU，放到独立的进程池中执行，避免阻塞 Web 线程
+    使用 spawn 方式创建子进程，子进程只需导入本模块
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, OPTIMIZE_WORKERS),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+
+def optimize_image(data, optimize, width=None, quality=OPTIMIZE_QUALITY):
+    """
+    在进程池中优化图片，返回 (数据, Content-Type, 扩展名)，无法处理时返回 None
+    """
+    return get_process_pool().submit(_optimize_image, data, optimize, parse_width(width), quality).result()
+
+
+def optimize_variants(data, optimize, widths, quality=OPTIMIZE_QUALITY):
+    """
+    在进程池中为多个目标宽度生成图片版本，用于 srcset
+    """
+    return get_process_pool().submit(_optimize_variants, data, optimize, list(widths), quality).result()
+
+
+def responsive_targets(width=None):
+    """
+    计算 srcset 的目标宽度
+    标签有像素宽度 W 时生成 1x/2x 两个版本（W、2W）；否则按 SRCSET_WIDTHS 断点生成
+    返回 [(目标宽度, 密度描述或 None), ...]
+    """
+    width = parse_width(width)
+    if width:
+        return [(width, '1x'), (width * 2, '2x')]
+    return [(breakpoint, None) for breakpoint in SRCSET_WIDTHS]
+
+
+def variant_name(optimize, width=None):
+    """
+    优化参数的简短描述，用于区分同一源图的不同处理结果
+    """
+    width = parse_width(width)
+    return f"{optimize}-q{OPTIMIZE_QUALITY}" + (f"-w{width}" if width else '')
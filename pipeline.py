@@ -0,0 +1,261 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# 并发配置：全局最大并发数，以及单个域名的初始并发数
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '8'))
+PER_HOST_LIMIT = int(os.getenv('PER_HOST_LIMIT', '4'))
+
+# 自适应调度：单个域名并发数的上限；源站响应变慢到基线的多少倍时视为拥塞
+HOST_MAX_LIMIT = int(os.getenv('HOST_MAX_LIMIT', '16'))
+HOST_SLOW_FACTOR = float(os.getenv('HOST_SLOW_FACTOR', '3'))
+# 遇到 429/503 时的最大重试次数，以及 Retry-After 的最长等待时间（秒）
+THROTTLE_RETRIES = int(os.getenv('THROTTLE_RETRIES', '3'))
+RETRY_AFTER_MAX = float(os.getenv('RETRY_AFTER_MAX', '120'))
+
+# 没有 Retry-After 时，被限流后暂停该域名的时间（秒）
+_THROTTLE_PAUSE = 1.0
+# 每个域名保留最近多少次响应时间，用于计算分位数
+_LATENCY_SAMPLES = 200
+
+
+def host_of(url):
+    return urlparse(url).netloc.lower() if isinstance(url, str) else ''
+
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头（秒数或 HTTP 日期），返回需要等待的秒数，无法解析时返回 None
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, seconds), RETRY_AFTER_MAX)
+
+
+class HostLimiter:
+    """
+    按域名限制并发数，避免同时向同一个站点发起过多请求
+    """
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self._condition = threading.Condition()
+        self._active = {}
+
+    def _capacity(self, host):
+        return self.limit
+
+    def _wait_time(self, host):
+        """
+        域名暂停接收请求的剩余秒数，0 表示可以发起请求
+        """
+        return 0
+
+    def _try_acquire_locked(self, host):
+        if self._wait_time(host) > 0 or self._active.get(host, 0) >= self._capacity(host):
+            return False
+        self._active[host] = self._active.get(host, 0) + 1
+        return True
+
+    def try_acquire(self, host):
+        """
+        不等待地占用该域名的一个并发名额，成功返回 True
+        """
+        with self._condition:
+            return self._try_acquire_locked(host)
+
+    def acquire(self, host):
+        with self._condition:
+            while not self._try_acquire_locked(host):
+                self._condition.wait(self._wait_time(host) or None)
+
+    def release(self, host):
+        with self._condition:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+            self._condition.notify_all()
+
+    def run(self, url, func, *args):
+        host = host_of(url)
+        self.acquire(host)
+        try:
+            return func(*args)
+        finally:
+            self.release(host)
+
+
+class AdaptiveHostLimiter(HostLimiter):
+    """
+    按域名自适应调整并发数（AIMD）
+
+    每次请求成功且响应时间正常时，并发数缓慢增加（每轮约 +1，不超过 max_limit）；
+    遇到 429/5xx、超时，或响应时间超过基线的 HOST_SLOW_FACTOR 倍时减半（不低于 1）。
+    429/503 携带 Retry-After 时，在该时间内暂停向此域名发起新请求。
+    """
+    def __init__(self, initial=PER_HOST_LIMIT, max_limit=HOST_MAX_LIMIT):
+        super().__init__(initial)
+        self.max_limit = max(self.limit, max_limit)
+        # host -> {'limit', 'baseline', 'paused_until', 'last_decrease', 'latencies'}
+        self._hosts = {}
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = {'limit': float(self.limit), 'baseline': None, 'paused_until': 0.0, 'last_decrease': 0.0,
+                     'latencies': deque(maxlen=_LATENCY_SAMPLES)}
+            self._hosts[host] = state
+        return state
+
+    def _capacity(self, host):
+        return int(self._state(host)['limit'])
+
+    def _wait_time(self, host):
+        return max(0.0, self._state(host)['paused_until'] - time.monotonic())
+
+    def _decrease(self, state):
+        # 同一时刻的多个失败只减半一次，避免并发数瞬间降到 1
+        now = time.monotonic()
+        if now - state['last_decrease'] < (state['baseline'] or _THROTTLE_PAUSE):
+            return
+        state['limit'] = max(1.0, state['limit'] / 2)
+        state['last_decrease'] = now
+
+    def on_success(self, host, latency):
+        with self._condition:
+            state = self._state(host)
+            state['latencies'].append(latency)
+            baseline = state['baseline']
+            if baseline is None or latency < baseline:
+                state['baseline'] = latency
+            else:
+                # 基线缓慢跟随正常波动
+                state['baseline'] = baseline * 0.95 + latency * 0.05
+            if baseline is not None and latency > baseline * HOST_SLOW_FACTOR:
+                self._decrease(state)
+            else:
+                state['limit'] = min(float(self.max_limit), state['limit'] + 1 / state['limit'])
+            self._condition.notify_all()
+
+    def on_error(self, host):
+        with self._condition:
+            self._decrease(self._state(host))
+
+    def on_throttle(self, host, retry_after=None):
+        with self._condition:
+            state = self._state(host)
+            self._decrease(state)
+            pause = retry_after if retry_after is not None else _THROTTLE_PAUSE
+            state['paused_until'] = max(state['paused_until'], time.monotonic() + pause)
+
+    def wait_until_open(self, host, timeout=None):
+        """
+        等待该域名的 Retry-After 暂停结束；传入 timeout 时最多等待该秒数，到期仍在暂停中返回 False
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._wait_time(host) <= 0, timeout)
+
+    def latency_percentile(self, host, percentile, min_samples=1):
+        """
+        该域名最近响应时间的分位数（秒），样本数不足 min_samples 时返回 None
+        """
+        with self._condition:
+            samples = sorted(self._state(host)['latencies'])
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def snapshot(self):
+        """
+        各域名当前的并发上限与进行中的请求数
+        """
+        with self._condition:
+            return {
+                host: {'limit': int(state['limit']), 'active': self._active.get(host, 0)}
+                for host, state in self._hosts.items()
+            }
+
+
+_scheduler = AdaptiveHostLimiter()
+
+
+def get_host_scheduler():
+    """
+    返回进程内共享的自适应域名调度器，同一域名的并发数在所有文章和请求间统一调整
+    """
+    return _scheduler
+
+
+def run_concurrent(func, items, url_of=None, max_workers=None, per_host=None, limiter=None, deadline=None):
+    """
+    并发执行 func(item)，返回与 items 顺序一致的结果列表
+
+    url_of 用于从 item 中取出图片URL以便按域名限流，默认 item 本身就是URL。
+    默认使用进程内共享的自适应调度器；指定 per_host 时改用固定上限的 HostLimiter。
+    任务按域名分组调度：某个域名没有空闲名额时先执行其他域名的任务，慢域名不会占满工作线程。
+    单个任务抛出的异常会被捕获，对应位置返回 None。
+    传入 deadline（deadline.Deadline）时，到期后不再开始新的任务，也不再等待进行中的任务，
+    未完成的位置返回 None；进行中的任务由其自身按截止时间中止。
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    url_of = url_of or (lambda item: item)
+    workers = min(max_workers or MAX_WORKERS, len(items))
+    limiter = limiter or (HostLimiter(per_host) if per_host else get_host_scheduler())
+    results = [None] * len(items)
+    running = 0
+    finished = threading.Condition()
+
+    def task(index, item, host):
+        nonlocal running
+        try:
+            results[index] = func(item)
+        except Exception as e:
+            print(f"❌ 任务执行失败: {e}")
+        finally:
+            limiter.release(host)
+            with finished:
+                running -= 1
+                finished.notify()
+
+    # 按域名分组，组内保持原顺序，组间按首次出现的顺序轮流调度
+    queues = OrderedDict()
+    for index, item in enumerate(items):
+        queues.setdefault(host_of(url_of(item)), deque()).append((index, item))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while queues and not (deadline and deadline.expired()):
+            with finished:
+                started = False
+                for host in list(queues):
+                    if running >= workers:
+                        break
+                    if not limiter.try_acquire(host):
+                        continue
+                    running += 1
+                    executor.submit(task, *queues[host].popleft(), host)
+                    started = True
+                    if not queues[host]:
+                        del queues[host]
+                if not started:
+                    # 等待任务完成；名额也可能被其他调用释放或暂停到期，因此定期重试
+                    finished.wait(0.05)
+        if deadline:
+            with finished:
+                finished.wait_for(lambda: not running, deadline.remaining())
+    finally:
+        executor.shutdown(wait=not deadline)
+    return list(results)
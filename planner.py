@@ -0,0 +1,104 @@
+import os
+from urllib.parse import urlparse
+from pipeline import run_concurrent, host_of
+from limits import check_size, ObjectTooLarge
+from data_uri import is_data_uri, DATA_URI_PATTERN
+
+# 预处理阶段配置：域名白名单 / 黑名单（逗号分隔，包含其子域名），留空不限制
+ALLOWED_DOMAINS = [d.strip().lower() for d in os.getenv('ALLOWED_DOMAINS', '').split(',') if d.strip()]
+DENIED_DOMAINS = [d.strip().lower() for d in os.getenv('DENIED_DOMAINS', '').split(',') if d.strip()]
+# 除 CUSTOM_DOMAIN 外，其他已经指向本存储桶的域名（如 r2.dev 公开地址），这些图片不再转存
+HOSTED_DOMAINS = [d.strip().lower() for d in os.getenv('HOSTED_DOMAINS', '').split(',') if d.strip()]
+# 开始传输前并发发送 HEAD 请求获取图片大小
+PLAN_HEAD_REQUESTS = os.getenv('PLAN_HEAD_REQUESTS', '').lower() in ('1', 'true', 'yes')
+
+# 跳过原因
+SKIP_HOSTED = 'hosted'
+SKIP_DENIED = 'denied'
+SKIP_NOT_ALLOWED = 'not_allowed'
+SKIP_UNSUPPORTED = 'unsupported'
+
+
+def domain_matches(host, domains):
+    host = host.split(':')[0]
+    return any(host == domain or host.endswith('.' + domain) for domain in domains)
+
+
+def skip_reason(url, hosted_prefixes=()):
+    """
+    判断图片是否不需要转存，返回跳过原因，需要转存时返回 None
+    hosted_prefixes 为本存储桶对外的URL前缀（自定义域名、S3 接口地址等）
+    内嵌的 base64 图片（data URI）不受域名规则限制，总是转存
+    """
+    if is_data_uri(url):
+        return None if DATA_URI_PATTERN.match(url) else SKIP_UNSUPPORTED
+    if urlparse(url).scheme not in ('http', 'https'):
+        return SKIP_UNSUPPORTED
+    host = host_of(url)
+    if any(url.startswith(prefix) for prefix in hosted_prefixes) or domain_matches(host, HOSTED_DOMAINS):
+        return SKIP_HOSTED
+    if domain_matches(host, DENIED_DOMAINS):
+        return SKIP_DENIED
+    if ALLOWED_DOMAINS and not domain_matches(host, ALLOWED_DOMAINS):
+        return SKIP_NOT_ALLOWED
+    return None
+
+
+def plan_transfers(items, hosted_prefixes=(), per_width=False):
+    """
+    传输计划：合并重复的URL，跳过不需要转存的图片
+
+    items 为 [(位置, URL, width), ...]；per_width 为 True 时（需要按宽度缩放）
+    同一URL的不同宽度分别传输。返回 (transfers, skipped)：
+    transfers 为 [{'url', 'width', 'positions', 'size', 'error'}, ...]，按首次出现的顺序排列；
+    skipped 为 {位置: 跳过原因}
+    """
+    transfers = {}
+    skipped = {}
+    for position, url, width in items:
+        reason = skip_reason(url, hosted_prefixes)
+        if reason:
+            skipped[position] = reason
+            continue
+        key = (url, width if per_width else None)
+        if key not in transfers:
+            transfers[key] = {'url': url, 'width': width, 'positions': [], 'size': None, 'error': None}
+        transfers[key]['positions'].append(position)
+    return list(transfers.values()), skipped
+
+
+def head_size(url, session, timeout=None):
+    """
+    发送 HEAD 请求获取 Content-Length，失败或源站不支持时返回 None
+    data URI 按 base64 长度估算，不发起请求
+    """
+    if is_data_uri(url):
+        match = DATA_URI_PATTERN.match(url)
+        return (len(url) - match.end()) * 3 // 4
+    try:
+        response = session.head(url, allow_redirects=True, timeout=timeout)
+        response.close()
+        if response.status_code >= 400:
+            return None
+        return int(response.headers['Content-Length'])
+    except Exception:
+        return None
+
+
+def size_transfers(transfers, session, deadline=None):
+    """
+    并发获取各图片的大小：超过 MAX_OBJECT_SIZE 的直接标记为失败，
+    其余按大小从大到小排列，大图片先开始，缩短整篇文章的完成时间
+    传入 deadline 时 HEAD 请求不超过截止时间，到期未返回的按大小未知处理
+    """
+    sizes = run_concurrent(lambda transfer: head_size(transfer['url'], session,
+                                                      deadline.remaining() if deadline else None),
+                           transfers, url_of=lambda transfer: transfer['url'], deadline=deadline)
+    for transfer, size in zip(transfers, sizes):
+        transfer['size'] = size
+        try:
+            check_size(size)
+        except ObjectTooLarge as e:
+            transfer['error'] = str(e)
+    transfers.sort(key=lambda transfer: transfer['size'] or 0, reverse=True)
+    return sum(transfer['size'] or 0 for transfer in transfers)
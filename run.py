@@ -1,10 +1,32 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import importlib.util
 import subprocess
 import sys
 import os
 
+# 读取 .env 中的启动配置；首次运行时可能尚未安装 python-dotenv
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+# 生产模式配置：worker 进程数、每个进程的线程数、单个请求的超时时间（秒）
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '2'))
+WEB_THREADS = int(os.getenv('WEB_THREADS', '8'))
+WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', '300'))
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '5001'))
+
+# 启动前检查的依赖模块（导入名）
+REQUIRED_MODULES = ('flask', 'boto3', 'requests', 'dotenv')
+
+def missing_modules():
+    return [name for name in REQUIRED_MODULES if importlib.util.find_spec(name) is None]
+
 def install_requirements():
     """安装必要的依赖"""
     print("正在安装依赖...")
@@ -16,26 +38,61 @@ def install_requirements():
         return False
     return True
 
+def run_production(workers, threads):
+    """
+    使用 Gunicorn 启动：多进程 × 多线程，每个 worker 进程各自创建 R2/HTTP 客户端
+    """
+    if importlib.util.find_spec('gunicorn') is None:
+        print("⚠️ 未安装 gunicorn（pip install gunicorn），改用单进程多线程模式启动")
+        from app import app
+        app.run(host=HOST, port=PORT, threaded=True)
+        return
+
+    print(f"🌐 生产模式: {workers} 个进程 × {threads} 个线程，监听 {HOST}:{PORT}")
+    os.execv(sys.executable, [
+        sys.executable, '-m', 'gunicorn',
+        '--workers', str(workers),
+        '--threads', str(threads),
+        '--worker-class', 'gthread',
+        '--timeout', str(WEB_TIMEOUT),
+        '--bind', f'{HOST}:{PORT}',
+        'app:app'
+    ])
+
 def main():
+    arg_parser = argparse.ArgumentParser(description="Markdown 图片上传器启动脚本")
+    arg_parser.add_argument('--prod', action='store_true',
+                            help="生产模式：使用 Gunicorn 多进程多线程运行，不开启调试")
+    arg_parser.add_argument('--workers', type=int, default=WEB_WORKERS,
+                            help=f"生产模式的 worker 进程数（默认 {WEB_WORKERS}）")
+    arg_parser.add_argument('--threads', type=int, default=WEB_THREADS,
+                            help=f"生产模式每个进程的线程数（默认 {WEB_THREADS}）")
+    arg_parser.add_argument('--install', action='store_true',
+                            help="启动前重新安装 requirements.txt 中的依赖")
+    args = arg_parser.parse_args()
+
     print("🚀 Markdown 图片上传器启动中...")
-    
-    # 检查依赖文件是否存在
-    if not os.path.exists("requirements.txt"):
-        print("❌ 未找到 requirements.txt 文件")
-        return
-    
-    # 安装依赖
-    if not install_requirements():
+
+    # 只有缺少依赖或显式要求时才安装，正常启动不再执行 pip
+    if args.install or missing_modules():
+        if not os.path.exists("requirements.txt"):
+            print("❌ 未找到 requirements.txt 文件")
+            return
+        if not install_requirements():
+            return
+
+    if args.prod:
+        run_production(args.workers, args.threads)
         return
-    
+
     # 启动Flask应用
     print("\n🌐 启动Web服务器...")
-    print("📱 请在浏览器中访问: http://localhost:5001")
+    print(f"📱 请在浏览器中访问: http://localhost:{PORT}")
     print("🛑 按 Ctrl+C 停止服务")
-    
+
     try:
         from app import app
-        app.run(debug=True, host='0.0.0.0', port=5001)
+        app.run(debug=True, host=HOST, port=PORT)
     except ImportError:
         print("❌ 未找到 app.py 文件")
     except KeyboardInterrupt:
@@ -44,4 +101,4 @@ def main():
         print(f"❌ 启动失败: {e}")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,652 @@
+import io
+import os
+import time
+import uuid
+import base64
+import hashlib
+import tempfile
+import threading
+import requests
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from url_cache import get_url_cache, conditional_headers
+from optimize import optimize_image, optimize_variants, variant_name
+from pipeline import run_concurrent, get_host_scheduler, host_of, parse_retry_after, THROTTLE_RETRIES
+from metrics import stage, add_timing, HEDGED_REQUESTS_TOTAL
+from limits import MAX_OBJECT_SIZE, BUDGET_WAIT_TIMEOUT, ObjectTooLarge, check_size, get_byte_budget
+from deadline import DeadlineExceeded
+from data_uri import is_data_uri, data_uri_extension, DataURIResponse
+from blob_cache import get_blob_cache
+
+# 流式传输配置：每个分片的大小，以及单个对象同时上传的分片数
+# 单次传输占用的内存约为 STREAM_CHUNK_SIZE * STREAM_CONCURRENCY，与图片大小无关
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', str(8 * 1024 * 1024)))
+STREAM_CONCURRENCY = int(os.getenv('STREAM_CONCURRENCY', '2'))
+
+# 对象命名方式：uuid 为随机文件名，hash 为内容的 SHA-256（相同内容只上传一次）
+KEY_MODES = ('uuid', 'hash')
+KEY_MODE = os.getenv('KEY_MODE', 'uuid')
+
+# hash 模式需要先读完内容才能确定文件名，超过该大小的内容暂存到临时文件
+SPOOL_MAX_SIZE = int(os.getenv('SPOOL_MAX_SIZE', str(8 * 1024 * 1024)))
+
+# 浏览器直传：签发预签名 PUT 地址，文件从浏览器直接上传到存储桶（需要为存储桶配置 CORS）
+DIRECT_UPLOAD = os.getenv('DIRECT_UPLOAD', '').lower() in ('1', 'true', 'yes')
+PRESIGN_EXPIRES = int(os.getenv('PRESIGN_EXPIRES', '900'))
+# 直传对象的元数据标记，确认上传时只接受带有该标记的对象
+DIRECT_UPLOAD_METADATA = {'upload': 'direct'}
+
+# 对冲请求：源站迟迟不返回响应头，超过该域名最近响应时间的 HEDGE_PERCENTILE 分位数时，
+# 再发出一个相同的请求，先返回的生效，另一个关闭。设为 0 关闭；样本少于 HEDGE_MIN_SAMPLES 时不对冲
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+# 设置了截止时间或对冲时，GET 请求在后台线程中发起，调用方只等待到截止时间；该线程池的大小（进程内共享）
+# 线程池占满时请求排队，排队的时间不计入域名的响应时间，也不计入对冲的等待时间
+REQUEST_THREADS = int(os.getenv('REQUEST_THREADS', '32'))
+# 对冲请求使用单独的线程池，不会排在已占满线程池的主请求之后
+HEDGE_THREADS = int(os.getenv('HEDGE_THREADS', '8'))
+# 主请求仍在线程池中排队时，检查它是否已经开始的间隔（秒）
+_HEDGE_POLL_INTERVAL = 0.05
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=STREAM_CHUNK_SIZE,
+    multipart_chunksize=STREAM_CHUNK_SIZE,
+    max_concurrency=STREAM_CONCURRENCY
+)
+# 上传时默认最多在内存中缓存 10 个分片，限制为并发数使内存占用与上面的估算一致
+TRANSFER_CONFIG.max_in_memory_upload_chunks = STREAM_CONCURRENCY
+
+# 本进程已确认存在于存储桶中的对象，命中时连 HEAD 请求都不需要
+_known_keys = set()
+_known_keys_lock = threading.Lock()
+
+
+class CountingReader:
+    """
+    包装文件对象，统计已读取的字节数
+    只暴露 read 方法，boto3 会按不可 seek 的流逐块读取
+    传入 stats 时，等待数据的时间计入 download 阶段；
+    传入 max_size 时，读取的数据超过上限会抛出 ObjectTooLarge（Content-Length 缺失或不实时也能拦住）；
+    传入 deadline 时，截止时间到期后的读取抛出 DeadlineExceeded，中止仍在进行的传输
+    """
+    def __init__(self, fileobj, stats=None, max_size=None, deadline=None):
+        self._fileobj = fileobj
+        self._stats = stats
+        self._max_size = max_size
+        self._deadline = deadline
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if self._deadline is not None:
+            self._deadline.check()
+        started = time.monotonic()
+        chunk = self._fileobj.read(size)
+        add_timing(self._stats, 'download', time.monotonic() - started)
+        self.bytes_read += len(chunk)
+        check_size(self.bytes_read, self._max_size)
+        return chunk
+
+
+def read_bounded(reader):
+    """
+    按 STREAM_CHUNK_SIZE 分块读完 reader 并返回全部内容
+    每读一块都由 CountingReader 检查大小，没有 Content-Length 的响应也会在超过上限时立即中止，
+    不会先把整个响应体读进内存
+    """
+    buffer = io.BytesIO()
+    while True:
+        chunk = reader.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer.write(chunk)
+    return buffer.getvalue()
+
+
+def file_extension(name, default_extension=''):
+    """
+    从URL或文件名中取出扩展名，data URI 按其 MIME 类型确定
+    """
+    if is_data_uri(name):
+        return data_uri_extension(name, default_extension)
+    original_filename = os.path.basename(name.split('?')[0])
+    return os.path.splitext(original_filename)[1] or default_extension
+
+
+def resolve_key_mode(key_mode=None):
+    """
+    校验命名方式，未指定时使用环境变量 KEY_MODE
+    """
+    key_mode = (key_mode or KEY_MODE).lower()
+    if key_mode not in KEY_MODES:
+        raise ValueError(f"不支持的命名方式: {key_mode}，可选值: {', '.join(KEY_MODES)}")
+    return key_mode
+
+
+# 源站限流或暂时不可用，需要按 Retry-After 等待后重试的状态码
+THROTTLE_STATUSES = (429, 503)
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _submit_request(pool, size, func, *args, **kwargs):
+    """
+    在进程内共享的线程池 pool 中执行 func，返回 Future；线程池在第一次使用时创建
+    """
+    with _executors_lock:
+        executor = _executors.get(pool)
+        if executor is None:
+            executor = _executors[pool] = ThreadPoolExecutor(max_workers=max(1, size), thread_name_prefix=pool)
+    return executor.submit(func, *args, **kwargs)
+
+
+def _timed_get(starts, name, http, url, **kwargs):
+    """
+    在线程池中发起 GET，真正开始时把时间记入 starts[name]，不包含在线程池中排队的时间
+    """
+    starts[name] = time.monotonic()
+    return http.get(url, **kwargs)
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+def guarded_get(http, url, headers, timeout, hedge_delay=None, deadline=None, scheduler=None, host=None):
+    """
+    在后台线程中发起流式 GET，调用方最多等待到截止时间（连接池的自动重试也不会超出）；
+    主请求开始后 hedge_delay 秒内没有收到响应头时，在单独的线程池中再发出一个相同的请求（对冲），
+    返回先成功的响应，其余的在完成后关闭。
+    传入 scheduler 时对冲请求同样要占用 host 的一个并发名额，名额已满（该域名正在降低并发）时不对冲。
+    返回 (响应, 该请求真正发起的时间)，用于计算不含排队时间的响应时间；
+    所有请求都失败时抛出最后一个异常，截止时间到期时抛出 DeadlineExceeded
+    """
+    starts = {}
+    kwargs = {'stream': True, 'headers': headers, 'timeout': timeout}
+    primary = _submit_request('request', REQUEST_THREADS, _timed_get, starts, 'primary', http, url, **kwargs)
+    names = {primary: 'primary'}
+    pending = {primary}
+    hedge = None
+    error = None
+    while pending:
+        wait_time = deadline.remaining() if deadline else None
+        if hedge is None and hedge_delay is not None:
+            began = starts.get('primary')
+            # 主请求还在排队时不开始计时，定期检查它是否已经发出
+            hedge_wait = (_HEDGE_POLL_INTERVAL if began is None
+                          else max(0.0, began + hedge_delay - time.monotonic()))
+            wait_time = hedge_wait if wait_time is None else min(hedge_wait, wait_time)
+        done, pending = wait(pending, wait_time, return_when=FIRST_COMPLETED)
+        if not done:
+            if hedge is None and hedge_delay is not None and not (deadline and deadline.expired()):
+                began = starts.get('primary')
+                if began is None or time.monotonic() - began < hedge_delay:
+                    continue
+                if scheduler is not None and not scheduler.try_acquire(host):
+                    print(f"⏸️ {host} 没有空闲的并发名额，不发出对冲请求: {url}")
+                    hedge_delay = None
+                    continue
+                print(f"🔀 源站 {hedge_delay:.2f} 秒内未响应，发出对冲请求: {url}")
+                hedge = _submit_request('hedge', HEDGE_THREADS, _timed_get, starts, 'hedge', http, url, **kwargs)
+                names[hedge] = 'hedge'
+                if scheduler is not None:
+                    hedge.add_done_callback(lambda future: scheduler.release(host))
+                pending.add(hedge)
+                continue
+            for future in pending:
+                future.add_done_callback(_close_response)
+            raise DeadlineExceeded(f"等待源站响应超过截止时间: {url}")
+        winners = [future for future in done if future.exception() is None]
+        if not winners:
+            error = done.pop().exception()
+            continue
+        winner = names[winners[0]]
+        if hedge is not None:
+            HEDGED_REQUESTS_TOTAL.inc(winner=winner)
+        for future in winners[1:] + list(pending):
+            future.add_done_callback(_close_response)
+        return winners[0].result(), starts[winner]
+    raise error
+
+
+def open_image_stream(image_url, headers=None, session=None, deadline=None):
+    """
+    以流的方式打开图片URL，不读取响应体
+    headers 可携带条件请求头，此时源站可能返回 304
+    session 为复用连接的 requests.Session，未传入时使用 requests 模块
+    deadline 为请求的截止时间，连接和读取超时不超过剩余时间
+
+    每次请求的结果反馈给自适应域名调度器；遇到 429/503 时按 Retry-After
+    暂停整个域名（其他图片也不会再发起请求），到期后重试，最多 THROTTLE_RETRIES 次。
+    响应头迟迟不返回、超过该域名响应时间的 HEDGE_PERCENTILE 分位数时发出对冲请求
+    data URI 不发起请求，直接返回按块解码的响应
+
+    非条件请求先查本地缓存（BLOB_CACHE_DIR），命中时直接读本地文件；
+    源站返回的内容在读取的同时写入本地缓存，供重试和按其他选项再次上传时使用
+    """
+    if is_data_uri(image_url):
+        return DataURIResponse(image_url)
+    blob_cache = get_blob_cache()
+    if blob_cache and headers is None:
+        cached = blob_cache.open(image_url)
+        if cached is not None:
+            print(f"📦 本地缓存命中: {image_url}")
+            return cached
+    scheduler = get_host_scheduler()
+    host = host_of(image_url)
+    for attempt in range(THROTTLE_RETRIES + 1):
+        if not scheduler.wait_until_open(host, deadline.timeout() if deadline else None):
+            raise DeadlineExceeded(f"{host} 限流暂停超过截止时间: {image_url}")
+        timeout = deadline.timeout() if deadline else None
+        hedge_delay = (scheduler.latency_percentile(host, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+                       if HEDGE_PERCENTILE else None)
+        started = time.monotonic()
+        try:
+            if hedge_delay is None and timeout is None:
+                response = (session or requests).get(image_url, stream=True, headers=headers)
+            else:
+                # 响应时间从请求真正发出时算起，不含在线程池中排队的时间
+                response, started = guarded_get(session or requests, image_url, headers, timeout, hedge_delay,
+                                                deadline, scheduler, host)
+        except (requests.RequestException, DeadlineExceeded):
+            scheduler.on_error(host)
+            raise
+
+        # 连接池内部对 5xx 的自动重试不会返回给调用方，也算作拥塞信号
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and any((item.status or 0) >= 500 for item in retries.history):
+            scheduler.on_error(host)
+
+        if response.status_code in THROTTLE_STATUSES:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            scheduler.on_throttle(host, retry_after)
+            if attempt < THROTTLE_RETRIES:
+                response.close()
+                print(f"⚠️ {host} 限流（{response.status_code}），{retry_after or 1:g} 秒后重试: {image_url}")
+                continue
+        elif response.status_code >= 500:
+            scheduler.on_error(host)
+        else:
+            scheduler.on_success(host, time.monotonic() - started)
+        break
+
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    # 让 urllib3 在读取时自动解压 gzip/deflate 编码的内容
+    response.raw.decode_content = True
+    if blob_cache and response.status_code == 200:
+        return blob_cache.wrap(image_url, response)
+    return response
+
+
+def response_size(response):
+    """
+    读取响应的 Content-Length 并检查是否超过 MAX_OBJECT_SIZE，超过时关闭响应并抛出异常
+    返回字节数，源站未提供时返回 None
+    """
+    try:
+        size = int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+    try:
+        check_size(size)
+    except Exception:
+        response.close()
+        raise
+    return size
+
+
+def memory_estimate(size, key_mode=None, full_read=False):
+    """
+    估算一次传输占用的内存，用于申请内存预算
+    流式上传只缓存有限的分片；hash 模式另有 SPOOL_MAX_SIZE 以内的暂存；
+    需要解码图片时整个文件都在内存中。size 未知时按 MAX_OBJECT_SIZE 估算
+    """
+    buffer_size = STREAM_CHUNK_SIZE * STREAM_CONCURRENCY
+    if size is None:
+        size = MAX_OBJECT_SIZE or buffer_size
+    if full_read:
+        return size
+    estimate = min(size, buffer_size)
+    if resolve_key_mode(key_mode) == 'hash':
+        estimate += min(size, SPOOL_MAX_SIZE)
+    return estimate
+
+
+@contextmanager
+def reserve_memory(response, estimate, deadline=None):
+    """
+    为即将读取的响应申请内存预算，等待超时（不超过截止时间）时关闭响应
+    """
+    budget = get_byte_budget()
+    try:
+        granted = budget.acquire(estimate, deadline.timeout(BUDGET_WAIT_TIMEOUT) if deadline else BUDGET_WAIT_TIMEOUT)
+    except Exception:
+        response.close()
+        raise
+    try:
+        yield
+    finally:
+        budget.release(granted)
+
+
+def spool_and_hash(fileobj):
+    """
+    边读取边计算 SHA-256，内容暂存在 SpooledTemporaryFile 中
+    返回 (spool, 十六进制摘要)，spool 已回到开头
+    """
+    digest = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        while True:
+            chunk = fileobj.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+            spool.write(chunk)
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool, digest.hexdigest()
+
+
+def object_exists(client, bucket, key):
+    """
+    检查对象是否已存在，优先查本地索引，其次发送 HEAD 请求
+    """
+    with _known_keys_lock:
+        if key in _known_keys:
+            return True
+    try:
+        client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    with _known_keys_lock:
+        _known_keys.add(key)
+    return True
+
+
+def put_stream(client, bucket, fileobj, extension, content_type, key_mode=None, stats=None):
+    """
+    将文件对象上传到R2，返回最终使用的对象名
+
+    uuid 模式下直接按分片流式上传；hash 模式下先计算内容摘要，
+    对象已存在时跳过上传，使重复上传同一内容成为幂等操作。
+    传入 stats 时记录 hash / upload 阶段的耗时。
+    """
+    extra_args = {'ACL': 'public-read', 'ContentType': content_type}
+
+    if resolve_key_mode(key_mode) == 'uuid':
+        key = f"{uuid.uuid4()}{extension}"
+        with stage(stats, 'upload'):
+            client.upload_fileobj(fileobj, bucket, key, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+        return key
+
+    with stage(stats, 'hash'):
+        spool, digest = spool_and_hash(fileobj)
+    with spool, stage(stats, 'upload'):
+        key = f"{digest}{extension}"
+        if object_exists(client, bucket, key):
+            print(f"♻️ 对象已存在，跳过上传: {key}")
+            return key
+        client.upload_fileobj(spool, bucket, key, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+    with _known_keys_lock:
+        _known_keys.add(key)
+    return key
+
+
+def presign_put(client, bucket, key, content_type, size, digest=None, expires=PRESIGN_EXPIRES):
+    """
+    签发上传单个对象的预签名 PUT 地址，返回 (url, headers)
+    对象名、Content-Type、ACL 和元数据都计入签名，浏览器必须原样带上 headers；
+    size 作为 Content-Length 计入签名（浏览器按文件大小自动发送），大小不符的上传会被存储端拒绝，
+    因此直传的对象不会超过签发时检查过的 MAX_OBJECT_SIZE；
+    传入 digest（十六进制 SHA-256）时同时签名 x-amz-checksum-sha256，存储端会拒绝内容不符的上传
+    """
+    check_size(size)
+    params = {
+        'Bucket': bucket,
+        'Key': key,
+        'ContentType': content_type,
+        'ContentLength': size,
+        'ACL': 'public-read',
+        'Metadata': DIRECT_UPLOAD_METADATA
+    }
+    headers = {'Content-Type': content_type, 'x-amz-acl': 'public-read'}
+    headers.update({f'x-amz-meta-{name}': value for name, value in DIRECT_UPLOAD_METADATA.items()})
+    if digest:
+        checksum = base64.b64encode(bytes.fromhex(digest)).decode('ascii')
+        params['ChecksumSHA256'] = checksum
+        headers['x-amz-checksum-sha256'] = checksum
+    url = client.generate_presigned_url('put_object', Params=params, ExpiresIn=expires)
+    return url, headers
+
+
+def confirm_direct_upload(client, bucket, key, stats=None):
+    """
+    确认浏览器直传的对象：必须带有直传标记，超过 MAX_OBJECT_SIZE 时删除并抛出 ObjectTooLarge
+    预签名地址已按签发时的大小限制了上传，这里再检查一次，防止上限调小前签发的地址
+    """
+    head = client.head_object(Bucket=bucket, Key=key)
+    if head.get('Metadata', {}).get('upload') != DIRECT_UPLOAD_METADATA['upload']:
+        raise ValueError(f"对象不是通过直传上传的: {key}")
+    size = head['ContentLength']
+    try:
+        check_size(size)
+    except ObjectTooLarge:
+        client.delete_object(Bucket=bucket, Key=key)
+        raise
+    if stats is not None:
+        stats['bytes'] = size
+    with _known_keys_lock:
+        _known_keys.add(key)
+    return key
+
+
+def adopt_content_key(client, bucket, temp_key, digest, extension, content_type):
+    """
+    将已上传到临时对象名的内容改为按 SHA-256 命名，返回最终对象名
+    目标已存在时直接删除临时对象；否则在R2服务端复制，不再经过本机传输数据
+    """
+    key = f"{digest}{extension}"
+    if object_exists(client, bucket, key):
+        print(f"♻️ 对象已存在，跳过上传: {key}")
+    else:
+        client.copy(
+            {'Bucket': bucket, 'Key': temp_key},
+            bucket,
+            key,
+            ExtraArgs={'ACL': 'public-read', 'ContentType': content_type, 'MetadataDirective': 'REPLACE'},
+            Config=TRANSFER_CONFIG
+        )
+        with _known_keys_lock:
+            _known_keys.add(key)
+    client.delete_object(Bucket=bucket, Key=temp_key)
+    return key
+
+
+def stream_to_r2(client, bucket, response, image_url, default_extension='', key_mode=None, stats=None,
+                 optimize=None, width=None, deadline=None):
+    """
+    将HTTP响应体按分片直接上传到R2，不把整张图片读进内存，返回对象名
+    指定 optimize 时需要完整解码图片，会先读入内存再优化后上传
+    传入 stats 字典时会写入传输的字节数和各阶段耗时
+    """
+    content_type = response.headers.get('Content-Type', 'image/jpeg')
+    extension = file_extension(image_url, default_extension)
+    reader = CountingReader(response.raw, stats, MAX_OBJECT_SIZE, deadline)
+    try:
+        if not optimize:
+            return put_stream(client, bucket, reader, extension, content_type, key_mode, stats)
+
+        data = read_bounded(reader)
+        with stage(stats, 'process'):
+            optimized = optimize_image(data, optimize, width)
+        if optimized:
+            data, content_type, extension = optimized
+            if stats is not None:
+                stats['optimized_bytes'] = len(data)
+        return put_stream(client, bucket, io.BytesIO(data), extension, content_type, key_mode, stats)
+    finally:
+        response.close()
+        if stats is not None:
+            stats['bytes'] = reader.bytes_read
+
+
+def url_cache_key(client, bucket, image_url, key_mode=None, variant=None):
+    """
+    URL缓存的键：同一源URL上传到不同的存储桶（含 endpoint）、使用不同的命名方式或优化参数时分别缓存，
+    hash 模式不会复用 uuid 模式留下的对象名
+    """
+    endpoint = getattr(getattr(client, 'meta', None), 'endpoint_url', '') or ''
+    key = f"{image_url}#{resolve_key_mode(key_mode)}@{endpoint}/{bucket}"
+    return f"{key}#{variant}" if variant else key
+
+
+def mirror_url(client, bucket, image_url, default_extension='', key_mode=None, stats=None, session=None,
+               optimize=None, width=None, deadline=None):
+    """
+    将源URL转存到R2并返回对象名
+
+    先查询URL缓存：TTL内直接复用；过期则带 ETag / Last-Modified 发起条件请求，
+    源站返回 304 时续期，否则重新下载上传并更新缓存。
+    同一源图的不同优化参数、命名方式和目标存储桶分别缓存。
+    传入 stats 字典时会写入 bytes（传输字节数）和 cached（是否复用缓存）。
+    传入 deadline 时，超过截止时间的下载会被中止并抛出 DeadlineExceeded。
+    """
+    if stats is not None:
+        stats.setdefault('bytes', 0)
+        stats['cached'] = False
+
+    # data URI 的内容就在文档中，不需要缓存（hash 模式下相同内容仍只保存一份）
+    cache = get_url_cache() if not is_data_uri(image_url) else None
+    cache_key = (url_cache_key(client, bucket, image_url, key_mode, variant_name(optimize, width) if optimize else None)
+                 if cache else None)
+    entry = cache.get(cache_key) if cache else None
+    if entry and entry['fresh']:
+        print(f"⚡ 缓存命中: {image_url}")
+        if stats is not None:
+            stats['cached'] = True
+        return entry['object_key']
+
+    with stage(stats, 'connect'):
+        response = open_image_stream(image_url, conditional_headers(entry) if entry else None, session, deadline)
+    if entry and response.status_code == 304:
+        response.close()
+        cache.touch(cache_key)
+        print(f"⚡ 源站确认未变化，沿用缓存: {image_url}")
+        if stats is not None:
+            stats['cached'] = True
+        return entry['object_key']
+
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    size = response_size(response)
+    with reserve_memory(response, memory_estimate(size, key_mode, full_read=bool(optimize)), deadline):
+        key = stream_to_r2(client, bucket, response, image_url, default_extension, key_mode, stats, optimize, width,
+                           deadline)
+    if cache:
+        cache.put(cache_key, key, etag, last_modified)
+    return key
+
+
+def mirror_variants(client, bucket, image_url, targets, optimize, key_mode=None, stats=None, session=None,
+                    deadline=None):
+    """
+    为源图生成多个宽度的版本并并发上传，用于响应式图片的 srcset
+
+    targets 为 [(目标宽度, 密度描述或 None), ...]，返回 [{'descriptor': ..., 'key': ...}, ...]；
+    descriptor 为 '1x'/'2x' 或 '<实际宽度>w'，不会放大原图，实际宽度相同的版本只保留一个。
+    图片无法解码时上传原图，返回的唯一版本 descriptor 为 None。
+    与 mirror_url 一样使用URL缓存、条件请求和截止时间。
+    """
+    if stats is not None:
+        stats.setdefault('bytes', 0)
+        stats['cached'] = False
+
+    target_names = ','.join(f"{width}{density or 'w'}" for width, density in targets)
+    cache = get_url_cache() if not is_data_uri(image_url) else None
+    cache_key = (url_cache_key(client, bucket, image_url, key_mode, f"srcset-{variant_name(optimize)}-{target_names}")
+                 if cache else None)
+    entry = cache.get(cache_key) if cache else None
+    if entry and entry['variants'] and entry['fresh']:
+        print(f"⚡ 缓存命中: {image_url}")
+        if stats is not None:
+            stats['cached'] = True
+        return entry['variants']
+
+    with stage(stats, 'connect'):
+        response = open_image_stream(image_url, conditional_headers(entry) if entry else None, session, deadline)
+    if entry and entry['variants'] and response.status_code == 304:
+        response.close()
+        cache.touch(cache_key)
+        print(f"⚡ 源站确认未变化，沿用缓存: {image_url}")
+        if stats is not None:
+            stats['cached'] = True
+        return entry['variants']
+
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    content_type = response.headers.get('Content-Type', 'image/jpeg')
+    size = response_size(response)
+    with reserve_memory(response, memory_estimate(size, full_read=True), deadline):
+        variants = _upload_variants(
+            client, bucket, response, image_url, targets, optimize, content_type, key_mode, stats, deadline
+        )
+
+    if cache:
+        cache.put(cache_key, variants[0]['key'], etag, last_modified, variants)
+    return variants
+
+
+def _upload_variants(client, bucket, response, image_url, targets, optimize, content_type, key_mode, stats,
+                     deadline=None):
+    """
+    读取源图，生成各个版本并上传，返回版本列表
+    """
+    reader = CountingReader(response.raw, stats, MAX_OBJECT_SIZE, deadline)
+    try:
+        data = read_bounded(reader)
+    finally:
+        response.close()
+        if stats is not None:
+            stats['bytes'] = reader.bytes_read
+
+    with stage(stats, 'process'):
+        encoded = optimize_variants(data, optimize, [width for width, _ in targets])
+    if encoded is None:
+        key = put_stream(client, bucket, io.BytesIO(data), file_extension(image_url), content_type, key_mode, stats)
+        variants = [{'descriptor': None, 'key': key}]
+    else:
+        # 去掉因原图不够大而与前一个版本宽度相同的版本
+        pending = []
+        seen_widths = set()
+        for (_, density), (_, actual_width, variant_data, variant_type, extension) in zip(targets, encoded):
+            if actual_width in seen_widths:
+                continue
+            seen_widths.add(actual_width)
+            pending.append((density or f"{actual_width}w", variant_data, variant_type, extension))
+
+        with stage(stats, 'upload'):
+            keys = run_concurrent(
+                lambda item: put_stream(client, bucket, io.BytesIO(item[1]), item[3], item[2], key_mode),
+                pending,
+                url_of=lambda item: None,
+                per_host=len(pending)
+            )
+        if not all(keys):
+            raise RuntimeError("部分图片版本上传失败")
+        variants = [{'descriptor': item[0], 'key': key} for item, key in zip(pending, keys)]
+        if stats is not None:
+            stats['optimized_bytes'] = sum(len(item[1]) for item in pending)
+    return variants
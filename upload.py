@@ -1,67 +1,50 @@
-import boto3
-import requests
-import os
-import uuid
-import re
-from html.parser import HTMLParser
 from dotenv import load_dotenv
 
-# 加载环境变量
+# 加载环境变量（需在导入其他模块前完成，它们在导入时读取配置）
 load_dotenv()
 
-# 从环境变量读取 Cloudflare R2 配置
-ACCESS_KEY_ID = os.getenv('ACCESS_KEY_ID')
-SECRET_ACCESS_KEY = os.getenv('SECRET_ACCESS_KEY')
-ENDPOINT_URL = os.getenv('ENDPOINT_URL')
-BUCKET_NAME = os.getenv('BUCKET_NAME')
-CUSTOM_DOMAIN = os.getenv('CUSTOM_DOMAIN', 'https://your-domain.com')
-
-# 检查必要的环境变量
-if not all([ACCESS_KEY_ID, SECRET_ACCESS_KEY, ENDPOINT_URL, BUCKET_NAME]):
-    raise ValueError("请在 .env 文件中配置所有必要的环境变量: ACCESS_KEY_ID, SECRET_ACCESS_KEY, ENDPOINT_URL, BUCKET_NAME")
-
-# Initialize a session using S3-compatible API
-session = boto3.session.Session()
-client = session.client('s3',
-                        region_name='auto',
-                        endpoint_url=ENDPOINT_URL,
-                        aws_access_key_id=ACCESS_KEY_ID,
-                        aws_secret_access_key=SECRET_ACCESS_KEY)
-
-class ImageHTMLParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.img_src = None
-        self.img_width = None
-    
-    def handle_starttag(self, tag, attrs):
-        if tag == 'img':
-            for attr, value in attrs:
-                if attr == 'src':
-                    self.img_src = value
-                elif attr == 'width':
-                    self.img_width = value
+import argparse
+import requests
+import os
+import re
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pipeline import run_concurrent, get_host_scheduler
+from core import upload_image, get_http_session, hosted_prefixes
+from transfer import KEY_MODES, resolve_key_mode
+from data_uri import describe_url
+from journal import get_journal, document_key
+from optimize import resolve_optimize
+from planner import plan_transfers, size_transfers, PLAN_HEAD_REQUESTS
+from document_stream import rewrite_markdown_stream
+from blob_cache import init_blob_cache
+from markdown_images import ImageHTMLParser, IMG_TAG_PATTERN, extract_images_from_markdown, rewrite_markdown
+
+# 批量模式：同时处理的文件数，以及默认的清单文件名
+BULK_WORKERS = int(os.getenv('BULK_WORKERS', '4'))
+MANIFEST_NAME = '.r2-manifest.json'
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+# 超过该大小（字节）的markdown文件改为流式处理，不整体读入内存
+STREAM_FILE_THRESHOLD = int(os.getenv('STREAM_FILE_THRESHOLD', str(32 * 1024 * 1024)))
 
 def extract_img_src_from_html(text):
     """
     从输入文本中提取所有<img>标签中的src链接和width属性
     """
-    # 使用正则表达式匹配所有<img>标签
-    pattern = r'<img\s+[^>]*>'
-    img_tags = re.findall(pattern, text, re.IGNORECASE | re.DOTALL)
-    
+    # 单次扫描所有<img>标签，并复用同一个解析器
+    parser = ImageHTMLParser()
     results = []
-    for img_tag in img_tags:
-        parser = ImageHTMLParser()
-        parser.feed(img_tag)
-        if parser.img_src:
+    for match in IMG_TAG_PATTERN.finditer(text):
+        img_src, img_width = parser.parse(match.group(0))
+        if img_src:
             results.append({
-                'src': parser.img_src,
-                'width': parser.img_width
+                'src': img_src,
+                'width': img_width
             })
     return results
 
-def upload_image_to_r2(image_url_or_html):
+def upload_image_to_r2(image_url_or_html, key_mode=None):
     """
     Downloads an image from a URL or HTML img tag, uploads it to Cloudflare R2,
     and returns the img tag result.
@@ -97,38 +80,9 @@ def upload_image_to_r2(image_url_or_html):
         width_attr = ''
 
     try:
-        # Download the image from the URL
-        print(f"Downloading image from: {image_url}")
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status()  # Raise an exception for bad status codes
-
-        # Create downloads directory if not exists
-        os.makedirs('downloads', exist_ok=True)
-
-        # Generate a random filename while preserving the extension
-        original_filename = os.path.basename(image_url.split('?')[0])
-        file_extension = os.path.splitext(original_filename)[1]
-        random_filename = f"{uuid.uuid4()}{file_extension}"
-        filename = random_filename
-
-        # Save image locally
-        local_path = os.path.join('downloads', filename)
-        with open(local_path, 'wb') as f:
-            f.write(response.content)
-        print(f"Saved locally to: {local_path}")
-
-        # Upload the image to R2 from local file
-        print(f"Uploading {filename} to R2 bucket: {BUCKET_NAME}...")
-        with open(local_path, 'rb') as file_obj:
-            client.upload_fileobj(
-                file_obj,
-                BUCKET_NAME,
-                filename,
-                ExtraArgs={'ACL': 'public-read', 'ContentType': response.headers.get('Content-Type', 'image/jpeg')}
-            )
-
-        # Construct the public URL of the uploaded image
-        public_url = f"{CUSTOM_DOMAIN}/{filename}" # Using custom domain
+        # Stream the image from the URL straight to R2, no local copy (cached URLs are reused)
+        print(f"Downloading image from: {describe_url(image_url)}")
+        public_url = upload_image(image_url, key_mode=key_mode)
         print(f"✅ Image uploaded successfully!")
         return f"<img src=\"{public_url}\"{width_attr} />"
 
@@ -137,45 +91,16 @@ def upload_image_to_r2(image_url_or_html):
     except Exception as e:
         return f"❌ An error occurred: {e}"
 
-def upload_image_with_width(image_url, width):
+def upload_image_with_width(image_url, width, key_mode=None):
     """
     上传图片并返回带指定width的img标签
     """
     try:
-        # Download the image from the URL
-        print(f"Downloading image from: {image_url}")
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status()
-
-        # Create downloads directory if not exists
-        os.makedirs('downloads', exist_ok=True)
-
-        # Generate a random filename while preserving the extension
-        original_filename = os.path.basename(image_url.split('?')[0])
-        file_extension = os.path.splitext(original_filename)[1]
-        random_filename = f"{uuid.uuid4()}{file_extension}"
-        filename = random_filename
-
-        # Save image locally
-        local_path = os.path.join('downloads', filename)
-        with open(local_path, 'wb') as f:
-            f.write(response.content)
-        print(f"Saved locally to: {local_path}")
-
-        # Upload the image to R2 from local file
-        print(f"Uploading {filename} to R2 bucket: {BUCKET_NAME}...")
-        with open(local_path, 'rb') as file_obj:
-            client.upload_fileobj(
-                file_obj,
-                BUCKET_NAME,
-                filename,
-                ExtraArgs={'ACL': 'public-read', 'ContentType': response.headers.get('Content-Type', 'image/jpeg')}
-            )
-
-        # Construct the public URL of the uploaded image
-        public_url = f"{CUSTOM_DOMAIN}/{filename}"
+        # Stream the image from the URL straight to R2, no local copy (cached URLs are reused)
+        print(f"Downloading image from: {describe_url(image_url)}")
+        public_url = upload_image(image_url, key_mode=key_mode, width=width)
         print(f"✅ Image uploaded successfully!")
-        
+
         width_attr = f' width="{width}"' if width else ''
         return f"<img src=\"{public_url}\"{width_attr} />"
 
@@ -184,7 +109,7 @@ def upload_image_with_width(image_url, width):
     except Exception as e:
         return f"❌ An error occurred: {e}"
 
-def process_input(input_text):
+def process_input(input_text, key_mode=None):
     """
     处理输入文本，支持单个URL、单个img标签、或多个<img>标签
     """
@@ -199,13 +124,13 @@ def process_input(input_text):
             return
         
         print(f"找到 {len(img_infos)} 个图片，开始批量处理...")
-        results = []
-        
-        for i, img_info in enumerate(img_infos, 1):
-            print(f"\n--- 处理第 {i} 个图片: {img_info['src']} ---")
-            result = upload_image_with_width(img_info['src'], img_info['width'])
-            if result:
-                results.append(result)
+        # 并发处理所有图片，结果顺序与输入一致
+        results = run_concurrent(
+            lambda img_info: upload_image_with_width(img_info['src'], img_info['width'], key_mode),
+            img_infos,
+            url_of=lambda img_info: img_info['src']
+        )
+        results = [result for result in results if result]
         
         print(f"\n🎉 批量处理完成！共处理 {len(img_infos)} 个图片")
         print("=" * 50)
@@ -214,11 +139,259 @@ def process_input(input_text):
         print("=" * 50)
     else:
         # 单个URL
-        result = upload_image_to_r2(stripped_input)
+        result = upload_image_to_r2(stripped_input, key_mode)
         if result:
             print(f"\n{result}\n")
 
+def upload_image_url(image_url, key_mode=None):
+    """
+    上传图片并返回公开URL，失败时返回 None
+    """
+    try:
+        return upload_image(image_url, key_mode=key_mode)
+    except Exception as e:
+        print(f"❌ 上传失败 {describe_url(image_url)}: {e}")
+        return None
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_fingerprint(path, digest=None):
+    """
+    清单中记录的文件指纹：修改时间、大小和内容摘要
+    """
+    stat = os.stat(path)
+    return {
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'sha256': digest or file_sha256(path)
+    }
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+def find_markdown_files(root, exclude_dir=None):
+    """
+    递归查找目录中的markdown文件，返回相对路径列表
+    """
+    exclude_dir = os.path.abspath(exclude_dir) if exclude_dir else None
+    results = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if not d.startswith('.') and os.path.abspath(os.path.join(dirpath, d)) != exclude_dir
+        )
+        for filename in sorted(filenames):
+            if filename.lower().endswith(MARKDOWN_EXTENSIONS):
+                results.append(os.path.relpath(os.path.join(dirpath, filename), root))
+    return results
+
+def needs_processing(src_path, dst_path, entry):
+    """
+    根据清单判断文件是否需要重新处理
+    修改时间和大小未变时直接跳过；否则比较内容摘要，避免仅 touch 过的文件被重复处理
+    返回 (是否需要处理, 内容摘要)
+    """
+    if entry is None or not os.path.exists(dst_path):
+        return True, None
+    stat = os.stat(src_path)
+    if stat.st_mtime == entry['mtime'] and stat.st_size == entry['size']:
+        return False, None
+    digest = file_sha256(src_path)
+    return digest != entry['sha256'], digest
+
+def process_markdown_stream(src_path, dst_path, key_mode=None, limiter=None):
+    """
+    流式处理markdown文件：分块读取、并发上传、按原顺序写出，内存占用与文件大小无关
+    返回 (图片总数, 失败数)。不使用进度日志，再次处理时由源URL缓存跳过已上传的图片
+    """
+    summary = {}
+    os.makedirs(os.path.dirname(os.path.abspath(dst_path)), exist_ok=True)
+    temp_path = f"{dst_path}.tmp"
+    with open(src_path, 'r', encoding='utf-8', newline='') as reader, \
+            open(temp_path, 'w', encoding='utf-8', newline='') as writer:
+        for piece in rewrite_markdown_stream(reader, lambda url, width: upload_image_url(url, key_mode), summary,
+                                             hosted_prefixes(), limiter=limiter):
+            writer.write(piece)
+    if not summary['total'] and src_path == dst_path:
+        os.remove(temp_path)
+    else:
+        os.replace(temp_path, dst_path)
+    return summary['total'], summary['failed']
+
+def process_markdown_file(src_path, dst_path, key_mode=None, limiter=None):
+    """
+    处理单个markdown文件中的图片并写入 dst_path（可与 src_path 相同）
+    返回 (图片总数, 失败数)
+    """
+    if os.path.getsize(src_path) > STREAM_FILE_THRESHOLD:
+        return process_markdown_stream(src_path, dst_path, key_mode, limiter)
+
+    with open(src_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+
+    images = extract_images_from_markdown(text)
+    failed = 0
+    if images:
+        # 与 Web 端共用进度日志：中断或部分失败后再次运行，已成功的图片不再重新上传
+        journal = get_journal()
+        document = document_key(text, key_mode=resolve_key_mode(key_mode), optimize=resolve_optimize(), srcset=False)
+        urls = [img_info['url'] for img_info in images]
+        new_urls = journal.results(document, urls) if journal else [None] * len(images)
+
+        # 重复的图片只传输一次，已托管或被域名规则排除的图片保持原样
+        transfers, skipped = plan_transfers(
+            [(position, url, None) for position, url in enumerate(urls) if not new_urls[position]],
+            hosted_prefixes()
+        )
+        if PLAN_HEAD_REQUESTS and transfers:
+            size_transfers(transfers, get_http_session())
+
+        def transfer(item):
+            if item['error']:
+                print(f"❌ 上传失败 {describe_url(item['url'])}: {item['error']}")
+                return None
+            new_url = upload_image_url(item['url'], key_mode)
+            if new_url and journal:
+                for position in item['positions']:
+                    journal.record(document, position, item['url'], new_url)
+            return new_url
+
+        for item, new_url in zip(transfers, run_concurrent(transfer, transfers, url_of=lambda item: item['url'],
+                                                           limiter=limiter)):
+            for position in item['positions']:
+                new_urls[position] = new_url
+        failed = sum(1 for position, new_url in enumerate(new_urls) if not new_url and position not in skipped)
+        if not failed and journal:
+            journal.forget(document)
+        text = rewrite_markdown(text, images, new_urls)
+    elif src_path == dst_path:
+        return 0, 0
+
+    # 先写临时文件再替换，中途中断不会留下写了一半的文件
+    os.makedirs(os.path.dirname(os.path.abspath(dst_path)), exist_ok=True)
+    temp_path = f"{dst_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, dst_path)
+    return len(images), failed
+
+def bulk_process(root, output_dir=None, key_mode=None, workers=BULK_WORKERS, manifest_path=None, force=False):
+    """
+    批量处理目录中的所有markdown文件
+    output_dir 为空时原地改写；清单记录每个文件处理后的指纹，再次运行时只处理有变化的文件。
+    有图片上传失败的文件不会写入清单，下次运行会重试。
+    """
+    target_root = output_dir or root
+    manifest_path = manifest_path or os.path.join(target_root, MANIFEST_NAME)
+    manifest = {} if force else load_manifest(manifest_path)
+
+    files = find_markdown_files(root, exclude_dir=output_dir)
+    pending = []
+    for rel_path in files:
+        src_path = os.path.join(root, rel_path)
+        dst_path = os.path.join(target_root, rel_path)
+        changed, digest = needs_processing(src_path, dst_path, manifest.get(rel_path))
+        if changed:
+            pending.append((rel_path, src_path, dst_path))
+        elif digest:
+            # 内容未变，仅更新修改时间，下次无需再计算摘要
+            manifest[rel_path] = file_fingerprint(src_path, digest)
+
+    print(f"共找到 {len(files)} 个markdown文件，其中 {len(pending)} 个需要处理")
+    if not pending:
+        save_manifest(manifest_path, manifest)
+        return
+
+    # 所有文件共享同一个自适应域名调度器
+    limiter = get_host_scheduler()
+    total_images = 0
+    total_failed = 0
+    failed_files = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {
+                executor.submit(process_markdown_file, src_path, dst_path, key_mode, limiter): (rel_path, src_path)
+                for rel_path, src_path, dst_path in pending
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                rel_path, src_path = futures[future]
+                try:
+                    image_count, failed = future.result()
+                except Exception as e:
+                    print(f"❌ [{done}/{len(pending)}] {rel_path}: {e}")
+                    failed_files.append(rel_path)
+                    continue
+
+                total_images += image_count
+                total_failed += failed
+                if failed:
+                    print(f"⚠️ [{done}/{len(pending)}] {rel_path}: {image_count} 个图片，{failed} 个失败")
+                    failed_files.append(rel_path)
+                    manifest.pop(rel_path, None)
+                else:
+                    print(f"✅ [{done}/{len(pending)}] {rel_path}: {image_count} 个图片")
+                    manifest[rel_path] = file_fingerprint(src_path)
+
+                if done % 50 == 0:
+                    save_manifest(manifest_path, manifest)
+    finally:
+        save_manifest(manifest_path, manifest)
+
+    print(f"\n🎉 批量处理完成！共处理 {len(pending)} 个文件、{total_images} 个图片，{total_failed} 个图片失败")
+    if failed_files:
+        print("以下文件存在失败，下次运行时会重试:")
+        for rel_path in failed_files:
+            print(f"  - {rel_path}")
+
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Cloudflare R2 Image Uploader")
+    arg_parser.add_argument('--key-mode', choices=KEY_MODES, default=None,
+                            help="对象命名方式：uuid 随机文件名，hash 按内容SHA-256命名并跳过已存在的对象")
+    arg_parser.add_argument('--bulk', metavar='DIR',
+                            help="批量模式：处理目录中所有markdown文件的图片，不进入交互模式")
+    arg_parser.add_argument('--stream', metavar='FILE',
+                            help="流式处理单个超大markdown文件，分块读取并边处理边写出")
+    arg_parser.add_argument('--output', metavar='DIR',
+                            help="批量模式的输出目录，保持原有目录结构；流式模式的输出文件")
+    arg_parser.add_argument('--in-place', action='store_true',
+                            help="批量模式或流式模式下直接改写原文件")
+    arg_parser.add_argument('--workers', type=int, default=BULK_WORKERS,
+                            help=f"批量模式同时处理的文件数（默认 {BULK_WORKERS}）")
+    arg_parser.add_argument('--manifest', metavar='PATH',
+                            help=f"清单文件路径（默认为输出目录下的 {MANIFEST_NAME}）")
+    arg_parser.add_argument('--force', action='store_true',
+                            help="忽略清单，重新处理所有文件")
+    args = arg_parser.parse_args()
+    init_blob_cache()
+
+    if args.stream:
+        if bool(args.output) == args.in_place:
+            arg_parser.error("流式模式需要指定 --output FILE 或 --in-place 其中之一")
+        image_count, failed = process_markdown_stream(args.stream, args.output or args.stream, args.key_mode)
+        print(f"🎉 处理完成！共 {image_count} 个图片，{failed} 个失败")
+        raise SystemExit(0)
+
+    if args.bulk:
+        if bool(args.output) == args.in_place:
+            arg_parser.error("批量模式需要指定 --output DIR 或 --in-place 其中之一")
+        bulk_process(args.bulk, args.output, args.key_mode, args.workers, args.manifest, args.force)
+        raise SystemExit(0)
+
     print("--- Cloudflare R2 Image Uploader ---")
     print("支持输入:")
     print("1. 单个图片URL")
@@ -231,4 +404,4 @@ if __name__ == "__main__":
         user_input = input("请输入 > ")
         if user_input.lower() in ['exit', 'quit']:
             break
-        process_input(user_input)
+        process_input(user_input, args.key_mode)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# 源URL → R2对象 的持久化缓存配置
+# URL_CACHE_PATH 设为空字符串可关闭缓存
+URL_CACHE_PATH = os.getenv('URL_CACHE_PATH', 'url_cache.sqlite3')
+URL_CACHE_TTL = int(os.getenv('URL_CACHE_TTL', str(24 * 3600)))
+URL_CACHE_MAX_ENTRIES = int(os.getenv('URL_CACHE_MAX_ENTRIES', '100000'))
+
+# 每写入多少条记录执行一次 LRU 淘汰
+_EVICT_EVERY = 100
+
+
+class UrlCache:
+    """
+    记录已经转存过的源URL，以及源站返回的 ETag / Last-Modified
+
+    条目在 TTL 内直接命中；过期后通过条件请求向源站确认，
+    返回 304 时续期而不重新下载。条目数超过上限时按最近使用时间淘汰。
+    """
+    def __init__(self, path, ttl=URL_CACHE_TTL, max_entries=URL_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS url_cache (
+                    source_url TEXT PRIMARY KEY,
+                    object_key TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    validated_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_url_cache_last_used ON url_cache (last_used)')
+            # 旧版本创建的缓存文件没有 variants 列
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(url_cache)')}
+            if 'variants' not in columns:
+                self._conn.execute('ALTER TABLE url_cache ADD COLUMN variants TEXT')
+
+    def get(self, source_url):
+        """
+        查询缓存，返回条目字典（含 fresh 字段表示是否仍在 TTL 内），未命中返回 None
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT object_key, etag, last_modified, validated_at, variants FROM url_cache WHERE source_url = ?',
+                (source_url,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE url_cache SET last_used = ? WHERE source_url = ?', (now, source_url))
+        object_key, etag, last_modified, validated_at, variants = row
+        return {
+            'object_key': object_key,
+            'variants': json.loads(variants) if variants else None,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': now - validated_at < self.ttl
+        }
+
+    def put(self, source_url, object_key, etag=None, last_modified=None, variants=None):
+        """
+        写入或覆盖一条记录，variants 为响应式图片的各个版本
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO url_cache '
+                '(source_url, object_key, etag, last_modified, validated_at, last_used, variants) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (source_url, object_key, etag, last_modified, now, now,
+                 json.dumps(variants) if variants is not None else None)
+            )
+            self._puts += 1
+            if self._puts % _EVICT_EVERY == 0:
+                self._evict()
+
+    def touch(self, source_url):
+        """
+        源站确认内容未变化（304）后续期
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE url_cache SET validated_at = ?, last_used = ? WHERE source_url = ?',
+                (now, now, source_url)
+            )
+
+    def _evict(self):
+        self._conn.execute('''
+            DELETE FROM url_cache WHERE source_url IN (
+                SELECT source_url FROM url_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_url_cache():
+    """
+    返回全局缓存实例，未配置 URL_CACHE_PATH 时返回 None
+    """
+    global _cache
+    if not URL_CACHE_PATH:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = UrlCache(URL_CACHE_PATH)
+        return _cache
+
+
+def conditional_headers(entry):
+    """
+    根据缓存条目构造条件请求头
+    """
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers